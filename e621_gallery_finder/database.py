@@ -1,46 +1,198 @@
 import datetime
+import queue
 import sqlite3
+import threading
 from contextlib import contextmanager
 from pathlib import Path
 from sqlite3 import Cursor
-from typing import Optional, Union, Tuple, Dict, ContextManager, List
+from typing import Optional, Union, Tuple, Dict, ContextManager, List, Set, Iterator
 
 
-from e621_gallery_finder.new_source import NewSourceEntry, PostStatusEntry
+from e621_gallery_finder.new_source import NewSourceEntry, PostStatusEntry, CachedPost, OutboxEntry
+
+
+ReviewCursor = Tuple[str, str, int]
+
+
+def review_cursor(post_status: PostStatusEntry) -> ReviewCursor:
+    """
+    Returns the cursor of a post's position in the review queue, as get_review_page would return it.
+    """
+    skip_key = str(post_status.skip_date) if post_status.skip_date else ""
+    return skip_key, str(post_status.last_checked), int(post_status.post_id)
 
 
 class Database:
     DB_FILE = "e6_post_sources.sqlite"
+    # Columns added since the table was first created, which older databases need adding before the schema is applied
+    ADDED_COLUMNS = [
+        ("post_status", "pending_review", "bool not null default false"),
+        ("post_status", "claimed_by", "str"),
+        ("post_status", "claimed_until", "date"),
+        ("post_new_sources", "match_algo", "str"),
+        ("post_new_sources", "match_distance", "integer"),
+        ("post_new_sources", "auto_approved", "bool not null default false"),
+    ]
+
+    BUSY_TIMEOUT = 30
 
-    def __init__(self) -> None:
-        self.conn = sqlite3.connect(self.DB_FILE, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+    def __init__(self, max_read_connections: int = 8) -> None:
+        # All writes go through this one connection, one thread at a time
+        self.conn = self._connect()
+        self.lock = threading.RLock()
+        self.transaction_depth = 0
+        self.transaction_thread: Optional[int] = None
+        # Reads use their own connections, which WAL lets carry on while the writer is busy
+        self.read_connections = queue.LifoQueue(maxsize=max_read_connections)
         self._create_db()
 
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.DB_FILE, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+
     def _create_db(self) -> None:
         cur = self.conn.cursor()
+        # WAL lets readers carry on during writes, and means commits don't need a full fsync each time
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        added_columns = self._add_missing_columns()
         schema_file = Path(__file__).parent / "db_schema.sql"
         with open(schema_file, "r") as f:
             cur.executescript(f.read())
         self.conn.commit()
+        self._add_unique_source_index()
+        if ("post_status", "pending_review") in added_columns:
+            self._just_execute(
+                "UPDATE post_status SET pending_review = EXISTS ("
+                "SELECT 1 FROM post_new_sources sources "
+                "WHERE sources.post_id = post_status.post_id AND sources.checked = false"
+                ")"
+            )
+        self._seed_source_stats()
+
+    def _seed_source_stats(self) -> None:
+        # Counts sources already in the database the first time round, after which the triggers keep the totals
+        with self._execute("SELECT COUNT(*) FROM source_stats") as result:
+            if result.fetchone()[0]:
+                return
+        self._just_execute(
+            "INSERT INTO source_stats (stat_name, value) "
+            "SELECT 'total', COUNT(*) FROM post_new_sources "
+            "UNION ALL SELECT 'unchecked', COUNT(*) FROM post_new_sources WHERE checked = 0 "
+            "UNION ALL SELECT 'approved', COUNT(*) FROM post_new_sources WHERE checked != 0 AND approved = 1 "
+            "UNION ALL SELECT 'rejected', COUNT(*) FROM post_new_sources "
+            "WHERE checked != 0 AND IFNULL(approved, 0) != 1"
+        )
+
+    def _add_missing_columns(self) -> List[Tuple[str, str]]:
+        added_columns = []
+        for table, column, column_def in self.ADDED_COLUMNS:
+            with self._execute(f"PRAGMA table_info({table})") as result:
+                existing_columns = [row[1] for row in result]
+            # A table which doesn't exist yet will be created with the column by the schema
+            if not existing_columns or column in existing_columns:
+                continue
+            self._just_execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_def}")
+            added_columns.append((table, column))
+        return added_columns
+
+    def _add_unique_source_index(self) -> None:
+        # Older databases could have duplicate sources from reprocessed posts, which need removing before the index
+        with self._execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'post_new_sources_unique_link'"
+        ) as result:
+            if result.fetchone() is not None:
+                return
+        self._just_execute(
+            "DELETE FROM post_new_sources WHERE source_id NOT IN ("
+            "SELECT source_id FROM ("
+            "SELECT source_id, ROW_NUMBER() OVER ("
+            "PARTITION BY post_id, submission_link ORDER BY checked DESC, source_id ASC"
+            ") AS row_num FROM post_new_sources"
+            ") WHERE row_num = 1"
+            ")"
+        )
+        self._just_execute(
+            "CREATE UNIQUE INDEX post_new_sources_unique_link ON post_new_sources (post_id, submission_link)"
+        )
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Groups statements into a single commit. Statements inside the block are not committed individually.
+        """
+        with self.lock:
+            self.transaction_depth += 1
+            self.transaction_thread = threading.get_ident()
+            try:
+                yield
+            except Exception:
+                if self.transaction_depth == 1:
+                    self.conn.rollback()
+                raise
+            else:
+                if self.transaction_depth == 1:
+                    self.conn.commit()
+            finally:
+                self.transaction_depth -= 1
+                if not self.transaction_depth:
+                    self.transaction_thread = None
 
     @contextmanager
     def _execute(self, query: str, args: Optional[Union[Tuple, Dict]] = None) -> ContextManager[Cursor]:
-        cur = self.conn.cursor()
+        with self.lock:
+            cur = self.conn.cursor()
+            try:
+                if args:
+                    result = cur.execute(query, args)
+                else:
+                    result = cur.execute(query)
+                if not self.transaction_depth:
+                    self.conn.commit()
+                yield result
+            finally:
+                cur.close()
+
+    @contextmanager
+    def _query(self, query: str, args: Optional[Union[Tuple, Dict]] = None) -> ContextManager[Cursor]:
+        # Reads inside a transaction need to see its uncommitted writes, so have to use the writer connection
+        if self.transaction_thread == threading.get_ident():
+            with self._execute(query, args) as result:
+                yield result
+            return
         try:
-            if args:
-                result = cur.execute(query, args)
-            else:
-                result = cur.execute(query)
-            self.conn.commit()
-            yield result
+            conn = self.read_connections.get_nowait()
+        except queue.Empty:
+            conn = self._connect(read_only=True)
+        cur = conn.cursor()
+        try:
+            yield cur.execute(query, args or ())
         finally:
             cur.close()
+            try:
+                self.read_connections.put_nowait(conn)
+            except queue.Full:
+                conn.close()
 
     def _just_execute(self, query: str, args: Optional[Union[Tuple, Dict]] = None) -> None:
         with self._execute(query, args):
             pass
 
+    def _execute_many(self, query: str, args_list: List[Union[Tuple, Dict]]) -> None:
+        with self.lock:
+            cur = self.conn.cursor()
+            try:
+                cur.executemany(query, args_list)
+                if not self.transaction_depth:
+                    self.conn.commit()
+            finally:
+                cur.close()
+
     def add_post(self, post_id: str, last_checked: datetime.datetime) -> None:
         self._just_execute(
             "INSERT INTO post_status (post_id, last_checked) "
@@ -50,30 +202,89 @@ class Database:
             (post_id, last_checked)
         )
 
+    def add_posts(self, post_ids: List[str], last_checked: datetime.datetime) -> None:
+        self._execute_many(
+            "INSERT INTO post_status (post_id, last_checked) "
+            "VALUES (?, ?) "
+            "ON CONFLICT (post_id) "
+            "DO UPDATE SET last_checked=excluded.last_checked",
+            [(post_id, last_checked) for post_id in post_ids]
+        )
+
+    def add_new_sources(
+            self,
+            new_sources: List[Tuple[str, Optional[str], Optional[str], Optional[str], Optional[int]]]
+    ) -> None:
+        self._execute_many(
+            "INSERT OR IGNORE INTO post_new_sources "
+            "(post_id, submission_link, direct_link, match_algo, match_distance) "
+            "VALUES (?, ?, ?, ?, ?)",
+            new_sources
+        )
+
+    def add_auto_approved_source(
+            self,
+            post_id: str,
+            submission_link: str,
+            direct_link: Optional[str],
+            match_algo: str,
+            match_distance: int,
+    ) -> bool:
+        with self._execute(
+            "INSERT OR IGNORE INTO post_new_sources "
+            "(post_id, submission_link, direct_link, match_algo, match_distance, checked, approved, auto_approved) "
+            "VALUES (?, ?, ?, ?, ?, True, True, True)",
+            (post_id, submission_link, direct_link, match_algo, match_distance)
+        ) as result:
+            return result.rowcount == 1
+
     def add_new_source(self, post_id: str, submission_link: Optional[str], direct_link: Optional[str]) -> None:
         self._just_execute(
-           "INSERT INTO post_new_sources (post_id, submission_link, direct_link) "
+           "INSERT OR IGNORE INTO post_new_sources (post_id, submission_link, direct_link) "
            "VALUES (?, ?, ?)",
             (post_id, submission_link, direct_link)
         )
 
-    def count_unchecked_sources(self) -> int:
-        with self._execute(
-            "SELECT COUNT(*) FROM post_new_sources WHERE checked = False"
+    def get_recently_checked_post_ids(
+            self,
+            matched_since: datetime.datetime,
+            unmatched_since: datetime.datetime
+    ) -> Set[str]:
+        post_ids = set()
+        with self._query(
+            "SELECT post_id FROM post_status posts "
+            "WHERE posts.last_checked > CASE "
+            "WHEN EXISTS (SELECT 1 FROM post_new_sources sources WHERE sources.post_id = posts.post_id) THEN ? "
+            "ELSE ? END",
+            (matched_since, unmatched_since)
         ) as result:
             for row in result:
-                return row[0]
-    
-    def count_total_sources(self) -> int:
-        with self._execute(
-            "SELECT COUNT(*) FROM post_new_sources"
+                post_ids.add(str(row[0]))
+        return post_ids
+
+    def get_source_stats(self) -> Dict[str, int]:
+        with self._query("SELECT stat_name, value FROM source_stats") as result:
+            return {row[0]: row[1] for row in result}
+
+    def get_daily_source_stats(self, days: int) -> Dict[str, Dict[str, int]]:
+        daily_stats = {}
+        with self._query(
+            "SELECT day, stat_name, value FROM source_daily_stats WHERE day > date('now', ?) ORDER BY day DESC",
+            (f"-{days} days",)
         ) as result:
             for row in result:
-                return row[0]
+                daily_stats.setdefault(row[0], {})[row[1]] = row[2]
+        return daily_stats
+
+    def count_unchecked_sources(self) -> int:
+        return self.get_source_stats().get("unchecked", 0)
+
+    def count_total_sources(self) -> int:
+        return self.get_source_stats().get("total", 0)
 
     def get_post_status(self, post_id: str) -> Optional[PostStatusEntry]:
         post_status = None
-        with self._execute(
+        with self._query(
             "SELECT skip_date, last_checked FROM post_status WHERE post_id = ?", (post_id,)
         ) as post_result:
             for row in post_result:
@@ -85,7 +296,7 @@ class Database:
     
     def get_unchecked_sources_by_post_id(self, post_id: str) -> List[NewSourceEntry]:
         new_sources = []
-        with self._execute(
+        with self._query(
             "SELECT source_id, submission_link, direct_link, checked, approved FROM post_new_sources "
             "WHERE post_id = ? AND checked = False",
                 (post_id,)
@@ -96,25 +307,114 @@ class Database:
                 ))
         return new_sources
 
+    def get_review_page(
+            self,
+            count: int,
+            after: Optional[ReviewCursor] = None,
+            reviewer: Optional[str] = None,
+    ) -> Tuple[List[Tuple[PostStatusEntry, List[NewSourceEntry]]], Optional[ReviewCursor]]:
+        """
+        Fetches a page of the review queue, along with the cursor to pass as `after` to fetch the page following it.
+        Posts claimed by other reviewers are left out, unless their claim has expired.
+        """
+        if after is None:
+            after = ("", "", -1)
+        page = []
+        cursor = None
+        page_columns = (
+            "SELECT post_id, skip_date, last_checked, IFNULL(skip_date, '') AS skip_key FROM post_status "
+            "WHERE (claimed_until IS NULL OR claimed_until <= :now OR claimed_by IS :reviewer) AND "
+        )
+        # The keyset condition is split in two, so that each half can seek straight to its start in the queue index
+        with self._query(
+            "WITH page AS ("
+            f"SELECT * FROM ({page_columns}"
+            "pending_review = 1 AND IFNULL(skip_date, '') = :skip_key "
+            "AND (last_checked, post_id) > (:last_checked, :post_id) "
+            "ORDER BY last_checked, post_id LIMIT :count"
+            ") UNION ALL "
+            f"SELECT * FROM ({page_columns}"
+            "pending_review = 1 AND IFNULL(skip_date, '') > :skip_key "
+            "ORDER BY IFNULL(skip_date, ''), last_checked, post_id LIMIT :count"
+            ") ORDER BY skip_key, last_checked, post_id LIMIT :count"
+            ") "
+            "SELECT page.post_id, page.skip_date, page.last_checked, "
+            "sources.source_id, sources.submission_link, sources.direct_link, sources.checked, sources.approved, "
+            "sources.match_algo, sources.match_distance "
+            "FROM page CROSS JOIN post_new_sources sources "
+            "ON sources.checked = false AND sources.post_id = page.post_id "
+            "ORDER BY page.skip_key, page.last_checked, page.post_id, sources.source_id",
+            {
+                "skip_key": after[0],
+                "last_checked": after[1],
+                "post_id": after[2],
+                "count": count,
+                "now": datetime.datetime.now(datetime.timezone.utc),
+                "reviewer": reviewer,
+            }
+        ) as result:
+            for row in result:
+                post_id = str(row[0])
+                if not page or page[-1][0].post_id != post_id:
+                    skip_date = None
+                    if row[1]:
+                        skip_date = datetime.datetime.fromisoformat(row[1])
+                    post_status = PostStatusEntry(post_id, skip_date, datetime.datetime.fromisoformat(row[2]))
+                    page.append((post_status, []))
+                    cursor = (row[1] or "", row[2], row[0])
+                page[-1][1].append(NewSourceEntry(row[4], row[5], row[3], row[6], row[7], row[8], row[9]))
+        return page, cursor
+
     def get_next_unchecked_sources(self, count: int = 1) -> List[Tuple[PostStatusEntry, List[NewSourceEntry]]]:
-        post_ids = []
-        with self._execute(
-            "SELECT sources.post_id "
-            "FROM post_new_sources sources "
-            "LEFT JOIN post_status posts ON posts.post_id = sources.post_id "
-            "WHERE checked = false "
-            "ORDER BY posts.skip_date ASC, posts.last_checked ASC"
-        ) as post_select:
-            for row in post_select:
-                post_ids.append(row[0])
-                if len(post_ids) >= count:
-                    break
-        results = []
-        for post_id in post_ids:
-            post_status = self.get_post_status(post_id)
-            new_sources = self.get_unchecked_sources_by_post_id(post_id)
-            results.append((post_status, new_sources))
-        return results
+        page, _ = self.get_review_page(count)
+        return page
+
+    def claim_review_page(
+            self,
+            reviewer: str,
+            count: int,
+            lease: datetime.timedelta,
+            after: Optional[ReviewCursor] = None,
+            include_own_claims: bool = True,
+    ) -> Tuple[List[Tuple[PostStatusEntry, List[NewSourceEntry]]], Optional[ReviewCursor]]:
+        """
+        Fetches a page of the review queue like get_review_page, and claims those posts for the reviewer until the
+        lease runs out, so that other reviewers are given different posts.
+        Posts the reviewer already holds are included again, unless include_own_claims is False.
+        """
+        claimed_until = datetime.datetime.now(datetime.timezone.utc) + lease
+        with self.transaction():
+            page, cursor = self.get_review_page(count, after, reviewer if include_own_claims else None)
+            self._execute_many(
+                "UPDATE post_status SET claimed_by = ?, claimed_until = ? WHERE post_id = ?",
+                [(reviewer, claimed_until, post_status.post_id) for post_status, _ in page]
+            )
+        return page, cursor
+
+    def claim_posts(self, reviewer: str, post_ids: List[str], lease: datetime.timedelta) -> Set[str]:
+        """
+        Claims whichever of the given posts are still waiting for review, and not already claimed by anyone, including
+        this reviewer, so that a post isn't handed to the same reviewer twice.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        claimed = set()
+        with self.transaction():
+            for post_id in post_ids:
+                with self._execute(
+                    "UPDATE post_status SET claimed_by = ?, claimed_until = ? "
+                    "WHERE post_id = ? AND pending_review = 1 "
+                    "AND (claimed_until IS NULL OR claimed_until <= ?)",
+                    (reviewer, now + lease, post_id, now)
+                ) as result:
+                    if result.rowcount:
+                        claimed.add(post_id)
+        return claimed
+
+    def release_claims(self, post_ids: List[str]) -> None:
+        self._execute_many(
+            "UPDATE post_status SET claimed_by = NULL, claimed_until = NULL WHERE post_id = ?",
+            [(post_id,) for post_id in post_ids]
+        )
 
     def update_post_skip(self, post_id: str, skip_date: datetime.datetime) -> None:
         self._just_execute(
@@ -128,8 +428,31 @@ class Database:
             (approved, source_id)
         )
 
+    def update_sources_approved(self, source_ids: List[int], approved: bool) -> None:
+        self._execute_many(
+            "UPDATE post_new_sources SET checked = True, approved = ? WHERE source_id = ?",
+            [(approved, source_id) for source_id in source_ids]
+        )
+
+    def get_sources(self, source_ids: List[int], post_id: Optional[str] = None) -> Dict[int, NewSourceEntry]:
+        """
+        Fetches the given sources by ID, leaving out any which don't exist, or don't belong to post_id if it is given.
+        """
+        sources = {}
+        for n in range(0, len(source_ids), 500):
+            chunk = source_ids[n:n + 500]
+            post_filter = "" if post_id is None else " AND post_id = ?"
+            with self._query(
+                f"SELECT source_id, submission_link, direct_link, checked, approved FROM post_new_sources "
+                f"WHERE source_id IN ({', '.join('?' for _ in chunk)}){post_filter}",
+                tuple(chunk) if post_id is None else (*chunk, post_id)
+            ) as result:
+                for row in result:
+                    sources[row[0]] = NewSourceEntry(row[1], row[2], row[0], row[3], row[4])
+        return sources
+
     def get_source(self, source_id: int) -> Optional[NewSourceEntry]:
-        with self._execute(
+        with self._query(
             "SELECT submission_link, direct_link, checked, approved FROM post_new_sources WHERE source_id = ?",
             (source_id,)
         ) as result:
@@ -142,3 +465,72 @@ class Database:
                     row[3]
                 )
         return None
+
+    def get_cached_posts(self, post_ids: List[str], fetched_since: datetime.datetime) -> Dict[str, CachedPost]:
+        cached_posts = {}
+        # Keep well within SQLite's limit on query parameters
+        for n in range(0, len(post_ids), 500):
+            chunk = post_ids[n:n + 500]
+            with self._query(
+                f"SELECT post_id, file_url, sources, fetched_at FROM post_cache "
+                f"WHERE post_id IN ({', '.join('?' for _ in chunk)}) AND fetched_at > ?",
+                (*chunk, fetched_since)
+            ) as result:
+                for row in result:
+                    cached_posts[str(row[0])] = CachedPost(
+                        str(row[0]),
+                        row[1],
+                        row[2].split("\n") if row[2] else [],
+                        datetime.datetime.fromisoformat(row[3])
+                    )
+        return cached_posts
+
+    def save_cached_posts(self, posts: List[CachedPost]) -> None:
+        self._execute_many(
+            "INSERT OR REPLACE INTO post_cache (post_id, file_url, sources, fetched_at) VALUES (?, ?, ?, ?)",
+            [(post.post_id, post.file_url, "\n".join(post.sources), post.fetched_at) for post in posts]
+        )
+
+    def remove_cached_post(self, post_id: str) -> None:
+        self._just_execute("DELETE FROM post_cache WHERE post_id = ?", (post_id,))
+
+    def add_outbox_entry(self, post_id: str, source_links: List[str]) -> None:
+        self._just_execute(
+            "INSERT INTO source_outbox (post_id, source_links, next_attempt) VALUES (?, ?, ?)",
+            (post_id, "\n".join(source_links), datetime.datetime.now(datetime.timezone.utc))
+        )
+
+    def get_due_outbox_entries(self, count: int) -> List[OutboxEntry]:
+        entries = []
+        with self._query(
+            "SELECT outbox_id, post_id, source_links, attempts FROM source_outbox "
+            "WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt ASC LIMIT ?",
+            (datetime.datetime.now(datetime.timezone.utc), count)
+        ) as result:
+            for row in result:
+                entries.append(OutboxEntry(row[0], str(row[1]), row[2].split("\n"), row[3]))
+        return entries
+
+    def update_outbox_done(self, outbox_id: int) -> None:
+        self._just_execute(
+            "UPDATE source_outbox SET status = 'done', attempts = attempts + 1, last_error = NULL "
+            "WHERE outbox_id = ?",
+            (outbox_id,)
+        )
+
+    def update_outbox_failure(self, outbox_id: int, error: str, next_attempt: Optional[datetime.datetime]) -> None:
+        if next_attempt is None:
+            self._just_execute(
+                "UPDATE source_outbox SET status = 'failed', attempts = attempts + 1, last_error = ? "
+                "WHERE outbox_id = ?",
+                (error, outbox_id)
+            )
+            return
+        self._just_execute(
+            "UPDATE source_outbox SET attempts = attempts + 1, last_error = ?, next_attempt = ? WHERE outbox_id = ?",
+            (error, next_attempt, outbox_id)
+        )
+
+    def count_outbox_by_status(self) -> Dict[str, int]:
+        with self._query("SELECT status, COUNT(*) FROM source_outbox GROUP BY status") as result:
+            return {row[0]: row[1] for row in result}
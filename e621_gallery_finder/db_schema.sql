@@ -2,7 +2,10 @@
 CREATE TABLE IF NOT EXISTS post_status (
     post_id str not null,
     skip_date date,
-    last_checked date
+    last_checked date,
+    pending_review bool not null default false,
+    claimed_by str,
+    claimed_until date
 );
 
 CREATE UNIQUE INDEX IF NOT EXISTS post_status_post_id
@@ -16,6 +19,134 @@ CREATE TABLE IF NOT EXISTS post_new_sources (
     submission_link str,
     direct_link str,
     checked bool not null default false,
-    approved bool
+    approved bool,
+    match_algo str,
+    match_distance integer,
+    auto_approved bool not null default false
 );
 
+CREATE INDEX IF NOT EXISTS post_new_sources_post_id
+    ON post_new_sources (post_id);
+
+CREATE INDEX IF NOT EXISTS post_new_sources_checked
+    ON post_new_sources (checked, post_id);
+
+-- The review queue only covers posts which still have unchecked sources, in order of skip date and last checked
+CREATE INDEX IF NOT EXISTS post_status_review_queue
+    ON post_status (IFNULL(skip_date, ''), last_checked, post_id)
+    WHERE pending_review = 1;
+
+CREATE TRIGGER IF NOT EXISTS post_status_insert_review
+    AFTER INSERT ON post_status
+BEGIN
+    UPDATE post_status SET pending_review = EXISTS (
+        SELECT 1 FROM post_new_sources WHERE post_id = new.post_id AND checked = false
+    ) WHERE post_id = new.post_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_new_sources_insert_review
+    AFTER INSERT ON post_new_sources
+    WHEN new.checked = false
+BEGIN
+    UPDATE post_status SET pending_review = 1 WHERE post_id = new.post_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_new_sources_update_review
+    AFTER UPDATE OF checked ON post_new_sources
+BEGIN
+    UPDATE post_status SET pending_review = EXISTS (
+        SELECT 1 FROM post_new_sources WHERE post_id = new.post_id AND checked = false
+    ) WHERE post_id = new.post_id;
+END;
+
+CREATE TABLE IF NOT EXISTS post_cache (
+    post_id str not null
+        constraint post_cache_pk
+            primary key,
+    file_url str,
+    sources str not null,
+    fetched_at date not null
+);
+
+CREATE TABLE IF NOT EXISTS source_outbox (
+    outbox_id integer
+        constraint source_outbox_pk
+            primary key autoincrement,
+    post_id str not null,
+    source_links str not null,
+    status str not null default 'pending',
+    attempts integer not null default 0,
+    next_attempt date not null,
+    last_error str
+);
+
+CREATE INDEX IF NOT EXISTS source_outbox_due
+    ON source_outbox (status, next_attempt);
+
+-- Running totals for the dashboard, kept up to date by the triggers below, so it doesn't need to count every source
+CREATE TABLE IF NOT EXISTS source_stats (
+    stat_name str not null
+        constraint source_stats_pk
+            primary key,
+    value integer not null default 0
+);
+
+CREATE TABLE IF NOT EXISTS source_daily_stats (
+    day date not null,
+    stat_name str not null,
+    value integer not null default 0,
+    constraint source_daily_stats_pk
+        primary key (day, stat_name)
+);
+
+CREATE TRIGGER IF NOT EXISTS post_new_sources_insert_stats
+    AFTER INSERT ON post_new_sources
+BEGIN
+    UPDATE source_stats SET value = value + CASE stat_name
+        WHEN 'total' THEN 1
+        WHEN 'unchecked' THEN new.checked = 0
+        WHEN 'approved' THEN new.checked != 0 AND new.approved = 1
+        WHEN 'rejected' THEN new.checked != 0 AND IFNULL(new.approved, 0) != 1
+        ELSE 0 END;
+    INSERT INTO source_daily_stats (day, stat_name, value) VALUES (date('now'), 'added', 1)
+        ON CONFLICT (day, stat_name) DO UPDATE SET value = value + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_new_sources_update_stats
+    AFTER UPDATE OF checked, approved ON post_new_sources
+BEGIN
+    UPDATE source_stats SET value = value + CASE stat_name
+        WHEN 'unchecked' THEN (new.checked = 0) - (old.checked = 0)
+        WHEN 'approved' THEN (new.checked != 0 AND new.approved = 1) - (old.checked != 0 AND old.approved = 1)
+        WHEN 'rejected' THEN
+            (new.checked != 0 AND IFNULL(new.approved, 0) != 1) - (old.checked != 0 AND IFNULL(old.approved, 0) != 1)
+        ELSE 0 END;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_new_sources_review_daily_stats
+    AFTER UPDATE OF checked ON post_new_sources
+    WHEN old.checked = 0 AND new.checked != 0
+BEGIN
+    INSERT INTO source_daily_stats (day, stat_name, value)
+        VALUES (date('now'), CASE WHEN new.approved = 1 THEN 'approved' ELSE 'rejected' END, 1)
+        ON CONFLICT (day, stat_name) DO UPDATE SET value = value + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_new_sources_delete_stats
+    AFTER DELETE ON post_new_sources
+BEGIN
+    UPDATE source_stats SET value = value - CASE stat_name
+        WHEN 'total' THEN 1
+        WHEN 'unchecked' THEN old.checked = 0
+        WHEN 'approved' THEN old.checked != 0 AND old.approved = 1
+        WHEN 'rejected' THEN old.checked != 0 AND IFNULL(old.approved, 0) != 1
+        ELSE 0 END;
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_new_sources_auto_approve_daily_stats
+    AFTER INSERT ON post_new_sources
+    WHEN new.auto_approved = 1
+BEGIN
+    INSERT INTO source_daily_stats (day, stat_name, value) VALUES (date('now'), 'auto_approved', 1)
+        ON CONFLICT (day, stat_name) DO UPDATE SET value = value + 1;
+END;
@@ -1,71 +1,213 @@
-import datetime
+import asyncio
+import dataclasses
+import re
+import threading
 import time
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
 
 import requests
+import requests.adapters
 import requests.auth
 
 
+class RateLimiter:
+    """
+    Thread-safe token bucket limiter, allowing short bursts up to capacity, while keeping the average rate.
+    Each caller reserves a token and then sleeps exactly until that token is available, so callers are served in order
+    without polling.
+    """
+
+    def __init__(self, rate: float = 1, capacity: float = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        # While paused, last_refill is the end of the pause, so no tokens build up until then
+        if now > self.last_refill:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+    def _reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            delay = max(0.0, self.last_refill - now)
+            if self.tokens >= 0:
+                return delay
+            return delay - self.tokens / self.rate
+
+    def wait(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self) -> None:
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Holds back all callers for the given time, for when the API asks us to back off
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Concurrent callers hitting the same back off all extend one deadline, rather than each adding to it.
+            # One token is left for the end of the pause, so the first caller goes exactly when it ends
+            self.tokens = min(self.tokens, 1)
+            self.last_refill = max(self.last_refill, now + seconds)
+
+
+@dataclasses.dataclass
+class LatencyStats:
+    count: int = 0
+    total: float = 0
+    max: float = 0
+
+    def record(self, latency: float) -> None:
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    @property
+    def mean(self) -> float:
+        if not self.count:
+            return 0
+        return self.total / self.count
+
+
 class E621API:
-    def __init__(self, user_agent: str, username: str, api_key: str):
+    POSTS_PER_PAGE = 100
+
+    def __init__(
+            self,
+            user_agent: str,
+            username: str,
+            api_key: str,
+            base_url: str = "https://e621.net",
+            limiter: Optional[RateLimiter] = None,
+            pool_size: int = 10,
+            max_retries: int = 5,
+    ):
         self.user_agent = user_agent
         self.username = username
         self.api_key = api_key
-        self.last_call = None
+        self.base_url = base_url.rstrip("/")
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.latencies: Dict[str, LatencyStats] = {}
+        self.latency_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = self.user_agent
+        self.session.auth = requests.auth.HTTPBasicAuth(self.username, self.api_key)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def wait_before_call(self) -> None:
-        now = datetime.datetime.now(datetime.timezone.utc)
-        if self.last_call is None:
-            self.last_call = now
-            return
-        while (now - self.last_call).total_seconds() < 1:
-            time.sleep(0.1)
-            now = datetime.datetime.now(datetime.timezone.utc)
-        self.last_call = now
-        return
+        self.limiter.wait()
+
+    def _record_latency(self, method: str, url: str, latency: float) -> None:
+        path = url[len(self.base_url):].split("?", 1)[0]
+        endpoint = f"{method} " + re.sub(r"\d+", "{id}", path)
+        with self.latency_lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = LatencyStats()
+            self.latencies[endpoint].record(latency)
+
+    def _request(self, method: str, url: str, **kwargs) -> Dict:
+        for attempt in range(self.max_retries + 1):
+            self.wait_before_call()
+            start_time = time.monotonic()
+            resp = self.session.request(method, url, **kwargs)
+            self._record_latency(method, url, time.monotonic() - start_time)
+            if resp.status_code not in [429, 503]:
+                return resp.json()
+            try:
+                retry_after = float(resp.headers["Retry-After"])
+            except (KeyError, ValueError):
+                retry_after = 2 ** attempt
+            print(f"E621 API responded {resp.status_code}, backing off for {retry_after} seconds")
+            self.limiter.pause(retry_after)
+        raise Exception(f"E621 API still rate limiting after {self.max_retries} retries: {method} {url}")
 
     def _get(self, url: str) -> Dict:
-        self.wait_before_call()
-        return requests.get(
-            url,
-            headers={
-                "User-Agent": self.user_agent
-            },
-            auth=requests.auth.HTTPBasicAuth(self.username, self.api_key)
-        ).json()
+        return self._request("GET", url)
 
     def _patch(self, url: str, json_data: Dict) -> Dict:
-        self.wait_before_call()
-        return requests.patch(
-            url,
-            headers={
-                "User-Agent": self.user_agent
-            },
-            data=json_data,
-            auth=requests.auth.HTTPBasicAuth(self.username, self.api_key)
-        ).json()
+        return self._request("PATCH", url, data=json_data)
+
+    def latency_report(self) -> str:
+        with self.latency_lock:
+            return "E621 API latency: " + ", ".join(
+                f"{endpoint}: {stats.count} calls, mean {stats.mean * 1000:.0f}ms, max {stats.max * 1000:.0f}ms"
+                for endpoint, stats in sorted(self.latencies.items())
+            )
 
     def get_post(self, post_id: str) -> Dict:
-        return self._get(f"https://e621.net/posts/{post_id}.json")
+        return self._get(f"{self.base_url}/posts/{post_id}.json")
+
+    def _get_posts_page(self, post_ids: List[str]) -> Dict:
+        return self._get(
+            f"{self.base_url}/posts.json?limit={len(post_ids)}"
+            f"&tags=id%3A{'%2C'.join(str(post_id) for post_id in post_ids)}+status%3Aany"
+        )
 
     def get_posts(self, post_ids: List[str]) -> Dict:
-        return self._get(f"https://e621.net/posts.json?tags=id%3A{'%2C'.join(str(post_id) for post_id in post_ids)}+status%3Aany")
+        chunks = [
+            post_ids[n:n + self.POSTS_PER_PAGE] for n in range(0, len(post_ids), self.POSTS_PER_PAGE)
+        ]
+        if len(chunks) <= 1:
+            return self._get_posts_page(post_ids) if post_ids else {"posts": []}
+        # Pages are still rate limited, but this lets them use any burst capacity the limiter has
+        with ThreadPoolExecutor(max_workers=min(len(chunks), max(1, int(self.limiter.capacity)))) as executor:
+            pages = list(executor.map(self._get_posts_page, chunks))
+        return {"posts": [post for page in pages for post in page["posts"]]}
 
-    def add_new_sources(self, post_id: str, new_source_links: List[str]) -> None:
-        current_post = self.get_post(post_id)
-        current_sources = current_post["post"]["sources"]
-        add_sources = set(new_source_links) - set(current_sources)
-        if not add_sources:
-            print(f"No need to add sources for post {post_id}")
-            return
-        source_diff = "\n".join(f"{source_link}" for source_link in add_sources)
+    def _patch_source_diff(self, post_id: str, source_diff: str, edit_reason: str) -> Dict:
         resp = self._patch(
-            f"https://e621.net/posts/{post_id}.json",
+            f"{self.base_url}/posts/{post_id}.json",
             {
                 "post[source_diff]": source_diff,
-                "post[edit_reason]": "Adding additional source links (e621_gallery_finder script)"
+                "post[edit_reason]": edit_reason
             }
         )
-        print(resp)
         if "success" in resp and resp["success"] is False:
             raise Exception(f"E621 API responded with an error: {resp['reason']}")
+        return resp
+
+    def add_new_sources(
+            self,
+            post_id: str,
+            new_source_links: List[str],
+            current_sources: Optional[List[str]] = None
+    ) -> Optional[Dict]:
+        if current_sources is None:
+            current_post = self.get_post(post_id)
+            current_sources = current_post["post"]["sources"]
+        add_sources = set(new_source_links) - set(current_sources)
+        if not add_sources:
+            print(f"No need to add sources for post {post_id}")
+            return None
+        source_diff = "\n".join(f"{source_link}" for source_link in add_sources)
+        resp = self._patch_source_diff(
+            post_id,
+            source_diff,
+            "Adding additional source links (e621_gallery_finder script)"
+        )
+        print(resp)
+        return resp
+
+    def replace_sources(self, post_id: str, replacements: Dict[str, str]) -> Dict:
+        source_diff = "\n".join(f"-{old_source}\n{new_source}" for old_source, new_source in replacements.items())
+        return self._patch_source_diff(
+            post_id,
+            source_diff,
+            "Fixing malformed source links (e621_source_cleanup script)"
+        )
@@ -0,0 +1,109 @@
+import datetime
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Optional, Callable, Any, Tuple
+
+import requests
+import requests.adapters
+
+from e621_gallery_finder.http_cache import ResponseCache
+
+DEFAULT_CACHE_TTLS = {
+    "hash_algos": datetime.timedelta(days=7),
+    "view_submission": datetime.timedelta(days=30),
+    "hash_search": datetime.timedelta(days=7),
+}
+
+
+class FAExportDB:
+    def __init__(
+            self,
+            base_url: str = "https://faexportdb.spangle.org.uk",
+            pool_size: int = 10,
+            cache: Optional[ResponseCache] = None,
+            max_memo_size: int = 100_000,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.max_memo_size = max_memo_size
+        # Many posts share hashes, so hash searches are memoised for the run, including ones still in flight
+        self.hash_search_memo: "OrderedDict[Tuple[int, str], Future]" = OrderedDict()
+        self.memo_lock = threading.Lock()
+        self.stats = Counter()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _count(self, stat: str) -> None:
+        with self.memo_lock:
+            self.stats[stat] += 1
+
+    def _fetch(self, endpoint: str, request: Any, fetch: Callable[[], requests.Response]) -> Dict:
+        if self.cache is not None:
+            cached = self.cache.get(endpoint, request)
+            if cached is not None:
+                self._count(f"{endpoint} disk hits")
+                return cached
+        self._count(f"{endpoint} misses")
+        resp = fetch()
+        data = resp.json()
+        if self.cache is not None and resp.status_code == 200:
+            self.cache.put(endpoint, request, data)
+        return data
+
+    def hash_algos(self) -> Dict:
+        return self._fetch(
+            "hash_algos",
+            None,
+            lambda: self.session.get(f"{self.base_url}/api/hash_algos.json")
+        )
+
+    def view_submission(self, site_id: str, submission_id: str) -> Dict:
+        return self._fetch(
+            "view_submission",
+            [site_id, submission_id],
+            lambda: self.session.get(f"{self.base_url}/api/view/submissions/{site_id}/{submission_id}.json")
+        )
+
+    def hash_search(self, algo_id: int, hash_value: str) -> Dict:
+        memo_key = (algo_id, hash_value)
+        with self.memo_lock:
+            memo_future = self.hash_search_memo.get(memo_key)
+            if memo_future is not None:
+                self.hash_search_memo.move_to_end(memo_key)
+                self.stats["hash_search memory hits"] += 1
+                return_memo = True
+            else:
+                memo_future = Future()
+                self.hash_search_memo[memo_key] = memo_future
+                if len(self.hash_search_memo) > self.max_memo_size:
+                    self.hash_search_memo.popitem(last=False)
+                return_memo = False
+        if return_memo:
+            return memo_future.result()
+        return self._hash_search_fetch(algo_id, hash_value, memo_future)
+
+    def _hash_search_fetch(self, algo_id: int, hash_value: str, memo_future: Future) -> Dict:
+        memo_key = (algo_id, hash_value)
+        request = {
+            "algo_id": algo_id,
+            "hash_value": hash_value,
+        }
+        try:
+            result = self._fetch(
+                "hash_search",
+                request,
+                lambda: self.session.post(f"{self.base_url}/api/hash_search/", json=request)
+            )
+        except Exception as e:
+            with self.memo_lock:
+                self.hash_search_memo.pop(memo_key, None)
+            memo_future.set_exception(e)
+            raise
+        memo_future.set_result(result)
+        return result
+
+    def cache_report(self) -> str:
+        return "faexportdb cache: " + ", ".join(f"{key}: {count}" for key, count in sorted(self.stats.items()))
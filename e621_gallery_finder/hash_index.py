@@ -0,0 +1,135 @@
+import json
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import tqdm
+
+PERCEPTUAL_ALGOS = {"python:phash", "python:dhash", "rust:dhash"}
+
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return bin(hash_a ^ hash_b).count("1")
+
+
+class MultiIndexHash:
+    """
+    Finds hashes within a hamming distance of a query hash. The hash bits are split into max_distance + 1 chunks, and
+    any hash within max_distance must match the query exactly on at least one chunk, so only hashes sharing a chunk
+    need their distance checking.
+    """
+
+    def __init__(self, bit_length: int, max_distance: int) -> None:
+        self.bit_length = bit_length
+        self.max_distance = max_distance
+        # There must be exactly max_distance + 1 chunks for the pigeonhole guarantee to hold, so chunk widths differ
+        # by up to a bit, rather than rounding them all up
+        chunk_count = max_distance + 1
+        bounds = [bit_length * n // chunk_count for n in range(chunk_count + 1)]
+        self.chunk_shapes = [
+            (start, (1 << (end - start)) - 1)
+            for start, end in zip(bounds, bounds[1:])
+        ]
+        self.chunk_tables: List[Dict[int, List[Tuple[int, int]]]] = [{} for _ in self.chunk_shapes]
+
+    def add(self, hash_int: int, item: int) -> None:
+        for (shift, mask), table in zip(self.chunk_shapes, self.chunk_tables):
+            table.setdefault((hash_int >> shift) & mask, []).append((hash_int, item))
+
+    def search(self, hash_int: int) -> Dict[int, int]:
+        matches = {}
+        for (shift, mask), table in zip(self.chunk_shapes, self.chunk_tables):
+            for candidate_hash, item in table.get((hash_int >> shift) & mask, []):
+                if item in matches:
+                    continue
+                distance = hamming_distance(hash_int, candidate_hash)
+                if distance <= self.max_distance:
+                    matches[item] = distance
+        return matches
+
+
+class LocalHashIndex:
+    """
+    Answers faexportdb lookups from a local export of snapshots, rather than with an HTTP call per post.
+    The export is a file of JSON lines, each one a snapshot in the same format returned by the faexportdb API.
+    With a max_distance of 0, hash searches return the same exact matches as the faexportdb API does. Above 0,
+    perceptual hashes also match near-duplicates within that hamming distance.
+    """
+
+    def __init__(self, hash_algos: Dict, max_distance: int = 0) -> None:
+        self._hash_algos = hash_algos
+        self.max_distance = max_distance
+        self.perceptual_algo_ids = {
+            algo_data["algo_id"] for algo_data in hash_algos["data"]["hash_algos"]
+            if f"{algo_data['language']}:{algo_data['algorithm_name']}" in PERCEPTUAL_ALGOS
+        }
+        self.snapshots: List[Dict] = []
+        self.submissions: Dict[Tuple[str, str], int] = {}
+        self.exact_index: Dict[Tuple[int, str], List[int]] = {}
+        self.near_index: Dict[Tuple[int, int], MultiIndexHash] = {}
+        self.stats = Counter()
+
+    @classmethod
+    def load(cls, snapshots_path: str, hash_algos_path: str, max_distance: int = 0) -> "LocalHashIndex":
+        with open(hash_algos_path, "r") as f:
+            index = cls(json.load(f), max_distance)
+        with open(snapshots_path, "r") as f:
+            for line in tqdm.tqdm(f, desc="Loading hash index"):
+                if line.strip():
+                    index.add_snapshot(json.loads(line))
+        return index
+
+    def add_snapshot(self, snapshot: Dict) -> None:
+        snapshot_num = len(self.snapshots)
+        self.snapshots.append(snapshot)
+        self.submissions[(snapshot["website_id"], snapshot["site_submission_id"])] = snapshot_num
+        for file in snapshot["submission_data"]["files"]:
+            for file_hash in file["file_hashes"]:
+                algo_id, hash_value = file_hash["algo_id"], file_hash["hash_value"]
+                self.exact_index.setdefault((algo_id, hash_value), []).append(snapshot_num)
+                if self.max_distance and algo_id in self.perceptual_algo_ids:
+                    self._add_near(algo_id, hash_value, snapshot_num)
+
+    def _add_near(self, algo_id: int, hash_value: str, snapshot_num: int) -> None:
+        try:
+            hash_int = int(hash_value, 16)
+        except ValueError:
+            return
+        bit_length = len(hash_value) * 4
+        if (algo_id, bit_length) not in self.near_index:
+            self.near_index[(algo_id, bit_length)] = MultiIndexHash(bit_length, self.max_distance)
+        self.near_index[(algo_id, bit_length)].add(hash_int, snapshot_num)
+
+    def hash_algos(self) -> Dict:
+        return self._hash_algos
+
+    def view_submission(self, site_id: str, submission_id: str) -> Dict:
+        self.stats["view_submission lookups"] += 1
+        snapshot_num = self.submissions.get((site_id, submission_id))
+        if snapshot_num is None:
+            return {"error": f"Submission {site_id}:{submission_id} is not in the local hash index"}
+        return {"data": self.snapshots[snapshot_num]}
+
+    def hash_search(self, algo_id: int, hash_value: str) -> Dict:
+        self.stats["hash_search lookups"] += 1
+        distances = {snapshot_num: 0 for snapshot_num in self.exact_index.get((algo_id, hash_value), [])}
+        near_index = self.near_index.get((algo_id, len(hash_value) * 4))
+        if near_index is not None:
+            try:
+                hash_int = int(hash_value, 16)
+            except ValueError:
+                hash_int = None
+            if hash_int is not None:
+                for snapshot_num, distance in near_index.search(hash_int).items():
+                    distances.setdefault(snapshot_num, distance)
+        results = []
+        for snapshot_num, distance in sorted(distances.items(), key=lambda item: item[1]):
+            snapshot = self.snapshots[snapshot_num]
+            if distance:
+                snapshot = {**snapshot, "hash_distance": distance}
+            results.append(snapshot)
+        return {"results": results}
+
+    def cache_report(self) -> str:
+        return f"Local hash index of {len(self.snapshots)} snapshots: " + ", ".join(
+            f"{key}: {count}" for key, count in sorted(self.stats.items())
+        )
@@ -0,0 +1,100 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Any
+
+
+class ResponseCache:
+    """
+    Persistent cache of JSON API responses, keyed by endpoint and request body.
+    Entries expire after a per-endpoint TTL, and the least recently used entries are evicted once the cache grows
+    beyond max_bytes.
+    """
+    DB_FILE = "faexportdb_cache.sqlite"
+
+    def __init__(
+            self,
+            ttls: Dict[str, Optional[datetime.timedelta]],
+            db_file: Optional[str] = None,
+            max_bytes: int = 1024 ** 3,
+    ) -> None:
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file or self.DB_FILE, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "endpoint str not null, "
+            "request str not null, "
+            "response str not null, "
+            "size integer not null, "
+            "fetched_at real not null, "
+            "last_used real not null, "
+            "primary key (endpoint, request)"
+            ")"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def _request_key(request: Any) -> str:
+        return json.dumps(request, sort_keys=True)
+
+    def get(self, endpoint: str, request: Any) -> Optional[Dict]:
+        request_key = self._request_key(request)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, fetched_at FROM responses WHERE endpoint = ? AND request = ?",
+                (endpoint, request_key)
+            ).fetchone()
+            if row is None:
+                return None
+            ttl = self.ttls.get(endpoint)
+            if ttl is not None and now - row[1] > ttl.total_seconds():
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE endpoint = ? AND request = ?",
+                    (now, endpoint, request_key)
+                )
+        return json.loads(row[0])
+
+    def put(self, endpoint: str, request: Any, response: Dict) -> None:
+        request_key = self._request_key(request)
+        response_str = json.dumps(response)
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                old_row = self.conn.execute(
+                    "SELECT size FROM responses WHERE endpoint = ? AND request = ?",
+                    (endpoint, request_key)
+                ).fetchone()
+                if old_row is not None:
+                    self.total_bytes -= old_row[0]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (endpoint, request, response, size, fetched_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (endpoint, request_key, response_str, len(response_str), now, now)
+                )
+                self.total_bytes += len(response_str)
+                if self.total_bytes > self.max_bytes:
+                    self._evict()
+
+    def _evict(self) -> None:
+        # Evict down to 90% of the size limit, so that eviction does not happen on every put
+        target_bytes = self.max_bytes * 0.9
+        cur = self.conn.execute("SELECT endpoint, request, size FROM responses ORDER BY last_used ASC")
+        evict_keys = []
+        for endpoint, request_key, size in cur:
+            if self.total_bytes <= target_bytes:
+                break
+            evict_keys.append((endpoint, request_key))
+            self.total_bytes -= size
+        cur.close()
+        self.conn.executemany("DELETE FROM responses WHERE endpoint = ? AND request = ?", evict_keys)
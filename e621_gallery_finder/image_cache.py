@@ -0,0 +1,260 @@
+import collections
+import dataclasses
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+import requests.adapters
+from PIL import Image
+
+
+class UnsupportedImage(Exception):
+    """
+    Raised for files which aren't proxied, because they are too large or aren't images, so should be linked directly.
+    """
+
+
+@dataclasses.dataclass
+class CachedImage:
+    key: str
+    path: Path
+    size: int
+    content_type: str
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+class ImageCache:
+    """
+    Fetches images for the review UI once, and keeps them on disk, evicting the least recently used once the cache
+    is over max_bytes. Images are shrunk to thumbnails before they are stored.
+    """
+    CACHE_DIR = "image_cache"
+    # By default, only the image hosts which the review queue links to are fetched, so the proxy can't be pointed
+    # anywhere else
+    ALLOWED_ORIGINS = {
+        "https://static1.e621.net",
+        "https://d.furaffinity.net",
+        "https://pbs.twimg.com",
+    }
+
+    def __init__(
+            self,
+            user_agent: str,
+            cache_dir: Optional[str] = None,
+            max_bytes: int = 2 * 1024 ** 3,
+            max_file_bytes: int = 20 * 1024 ** 2,
+            thumbnail_size: Tuple[int, int] = (800, 800),
+            prefetch_workers: int = 4,
+            allowed_origins: Optional[Set[str]] = None,
+    ) -> None:
+        self.allowed_origins = set(self.ALLOWED_ORIGINS if allowed_origins is None else allowed_origins)
+        self.cache_dir = Path(cache_dir or self.CACHE_DIR)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.thumbnail_size = thumbnail_size
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        adapter = requests.adapters.HTTPAdapter(pool_connections=prefetch_workers, pool_maxsize=prefetch_workers * 2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.images: "collections.OrderedDict[str, CachedImage]" = collections.OrderedDict()
+        self.in_flight: Dict[str, Future] = {}
+        # Keys of files which were too large or weren't images, so that they aren't downloaded again on every view
+        self.unsupported: Set[str] = set()
+        self.total_bytes = 0
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="image_prefetch")
+        self._load_index()
+
+    def _load_index(self) -> None:
+        # File modification times are kept up to date on each use, so the LRU order survives restarts
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            path = self.cache_dir / name
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            self.images[path.stem] = CachedImage(path.stem, path, size, content_type)
+            self.total_bytes += size
+
+    def is_allowed(self, url: str) -> bool:
+        """
+        Checks the URL is on one of the allowed origins, given as scheme://host, plus :port if it isn't the default.
+        """
+        try:
+            parsed = urllib.parse.urlsplit(url)
+            port = parsed.port
+        except ValueError:
+            return False
+        if parsed.username is not None or parsed.password is not None:
+            return False
+        origin = f"{parsed.scheme}://{parsed.hostname}" + (f":{port}" if port is not None else "")
+        return origin in self.allowed_origins
+
+    @staticmethod
+    def cache_key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[CachedImage]:
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                return None
+            self.images.move_to_end(key)
+        try:
+            os.utime(image.path)
+        except OSError:
+            pass
+        return image
+
+    def get(self, url: str) -> Tuple[bytes, str]:
+        """
+        Returns the image data and content type for the given URL, fetching it if it isn't cached yet.
+        Raises UnsupportedImage if the file is too large, or isn't an image.
+        """
+        key = self.cache_key(url)
+        if key in self.unsupported:
+            raise UnsupportedImage(f"Not caching {url}")
+        image = self._lookup(key)
+        if image is not None:
+            try:
+                return image.read(), image.content_type
+            except FileNotFoundError:
+                self._forget(key)
+        return self._fetch_once(url, key).result()
+
+    def prefetch(self, urls: List[Optional[str]]) -> None:
+        for url in urls:
+            if url is None or not self.is_allowed(url):
+                continue
+            key = self.cache_key(url)
+            with self.lock:
+                if key in self.images or key in self.in_flight or key in self.unsupported:
+                    continue
+            self.prefetch_executor.submit(self._prefetch_one, url, key)
+
+    def _prefetch_one(self, url: str, key: str) -> None:
+        if self._lookup(key) is not None:
+            return
+        try:
+            self._fetch_once(url, key).result()
+        except UnsupportedImage:
+            pass
+        except Exception as e:
+            print(f"Failed to prefetch image {url}: {e}")
+
+    def _fetch_once(self, url: str, key: str) -> Future:
+        # Requests for an image which is already being fetched wait for that fetch, rather than starting another
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self.in_flight[key] = future
+        try:
+            future.set_result(self._fetch(url, key))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return future
+
+    def _fetch(self, url: str, key: str) -> Tuple[bytes, str]:
+        # Redirects aren't followed, as they could lead off the allowed hosts
+        with self.session.get(url, timeout=30, stream=True, allow_redirects=False) as resp:
+            resp.raise_for_status()
+            content_type = resp.headers.get("Content-Type", "application/octet-stream").split(";")[0].strip()
+            if not content_type.startswith("image/"):
+                self._mark_unsupported(key)
+                raise UnsupportedImage(f"{url} is {content_type}, not an image")
+            if int(resp.headers.get("Content-Length") or 0) > self.max_file_bytes:
+                self._mark_unsupported(key)
+                raise UnsupportedImage(f"{url} is larger than {self.max_file_bytes} bytes")
+            # Content-Length can be missing or wrong, so the limit is checked as the file is read, too
+            chunks = []
+            size = 0
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > self.max_file_bytes:
+                    self._mark_unsupported(key)
+                    raise UnsupportedImage(f"{url} is larger than {self.max_file_bytes} bytes")
+                chunks.append(chunk)
+        data, content_type = self._thumbnail(b"".join(chunks), content_type)
+        self._store(key, data, content_type)
+        return data, content_type
+
+    def _mark_unsupported(self, key: str) -> None:
+        with self.lock:
+            self.unsupported.add(key)
+
+    def _thumbnail(self, data: bytes, content_type: str) -> Tuple[bytes, str]:
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                # Shrinking an animation would only keep its first frame
+                if getattr(image, "is_animated", False):
+                    return data, content_type
+                image.thumbnail(self.thumbnail_size)
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+                output = io.BytesIO()
+                image.save(output, "JPEG", quality=85)
+                return output.getvalue(), "image/jpeg"
+        except (OSError, ValueError):
+            return data, content_type
+
+    def _store(self, key: str, data: bytes, content_type: str) -> None:
+        extension = mimetypes.guess_extension(content_type) or ".bin"
+        path = self.cache_dir / f"{key}{extension}"
+        tmp_path = self.cache_dir / f"{key}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            old_image = self.images.pop(key, None)
+            if old_image is not None:
+                self.total_bytes -= old_image.size
+            self.images[key] = CachedImage(key, path, len(data), content_type)
+            self.total_bytes += len(data)
+            evicted = self._evict()
+        if old_image is not None and old_image.path != path:
+            evicted.append(old_image)
+        for image in evicted:
+            try:
+                os.remove(image.path)
+            except OSError:
+                pass
+
+    def _evict(self) -> List[CachedImage]:
+        if self.total_bytes <= self.max_bytes:
+            return []
+        # Evict down to 90% of the limit, so there's room for a few more images before evicting again
+        evicted = []
+        while self.images and self.total_bytes > self.max_bytes * 0.9:
+            _, image = self.images.popitem(last=False)
+            self.total_bytes -= image.size
+            evicted.append(image)
+        return evicted
+
+    def _forget(self, key: str) -> None:
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is not None:
+                self.total_bytes -= image.size
+
+    def cache_report(self) -> str:
+        with self.lock:
+            return f"Image cache: {len(self.images)} images, {self.total_bytes / 1024 ** 2:.1f}MB"
@@ -1,24 +1,28 @@
 import csv
 import datetime
 import json
-from typing import List, Dict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Optional, Tuple, Deque, Union, Iterable, Iterator, Set
 
 import tqdm
-import requests
 
 from e621_gallery_finder.database import Database
 from e621_gallery_finder.e621_api import E621API
-from e621_gallery_finder.new_source import NewSource, post_to_url
+from e621_gallery_finder.faexportdb import FAExportDB, DEFAULT_CACHE_TTLS
+from e621_gallery_finder.hash_index import LocalHashIndex
+from e621_gallery_finder.http_cache import ResponseCache
+from e621_gallery_finder.new_source import NewSource, MatchedSource, post_to_url, EXACT_HASH_ALGOS
+from e621_gallery_finder.pipeline import Pipeline
 from e621_gallery_finder.post_issues import PostIssues
 from e621_gallery_finder.source_checks import FAUserLink, FADirectLink, TwitterGallery, TwitterDirectLink, \
-    FixableSourceMatch
+    FixableSourceMatch, MatchInfo, SnapshotInfo
 from e621_source_cleanup.checks.base import BaseCheck
 from e621_source_cleanup.main import setup_max_int, fetch_db_dump_path, csv_line_count
 
 
-def scan_csv(csv_path: str, checks: List[BaseCheck]) -> Dict[str, List[FixableSourceMatch]]:
+def iter_matches(csv_path: str, checks: List[BaseCheck]) -> Iterator[Tuple[str, List[FixableSourceMatch]]]:
     total_lines = csv_line_count(csv_path)
-    match_dict = {}
     with open(csv_path, "r", encoding="utf-8") as f:
         reader = csv.reader(f)
         next(reader, None)
@@ -38,9 +42,11 @@ def scan_csv(csv_path: str, checks: List[BaseCheck]) -> Dict[str, List[FixableSo
                 if matches:
                     all_matches.extend(matches)
             if all_matches:
-                match_dict[post_id] = all_matches
-                # print(f"Found {len(all_matches)} source match: {all_matches}")
-    return match_dict
+                yield post_id, all_matches
+
+
+def scan_csv(csv_path: str, checks: List[BaseCheck]) -> Dict[str, List[FixableSourceMatch]]:
+    return dict(iter_matches(csv_path, checks))
 
 
 class PostFixer:
@@ -55,15 +61,32 @@ class PostFixer:
     ]
     _hash_id_priority = None
 
-    def __init__(self, e6_api: "E621API", db: Database) -> None:
+    def __init__(
+            self,
+            e6_api: "E621API",
+            db: Database,
+            faexportdb: Optional[Union[FAExportDB, LocalHashIndex]] = None,
+            concurrency: int = 10,
+            recheck_age: Optional[datetime.timedelta] = None,
+            no_match_recheck_age: datetime.timedelta = datetime.timedelta(days=30),
+            write_batch_size: int = 100,
+            auto_approve: bool = True,
+    ) -> None:
         self.api = e6_api
         self.db = db
+        self.faexportdb = faexportdb or FAExportDB(pool_size=concurrency)
+        self.concurrency = concurrency
+        self.recheck_age = recheck_age
+        self.no_match_recheck_age = no_match_recheck_age
+        self.write_batch_size = write_batch_size
+        self.auto_approve = auto_approve
+        self.auto_approved_count = 0
 
     @property
     def hash_id_priority(self) -> List[int]:
         if self._hash_id_priority is not None:
             return self._hash_id_priority
-        hash_algos = requests.get("https://faexportdb.spangle.org.uk/api/hash_algos.json").json()
+        hash_algos = self.faexportdb.hash_algos()
         id_priority = []
         for algo_name in self.hash_priority:
             found = False
@@ -77,27 +100,73 @@ class PostFixer:
         self._hash_id_priority = id_priority
         return id_priority
 
-    def find_matching_source(self, post_id: str, post_issues: PostIssues) -> List[NewSource]:
-        faxdb_post_data = requests.get(
-            f"https://faexportdb.spangle.org.uk/api/view/submissions/e621/{post_id}.json"
-        ).json()
+    def describe_match(
+            self,
+            snapshot_info: SnapshotInfo,
+            match_info: MatchInfo,
+            hash_id: int,
+            post_exact_hashes: Set[Tuple[int, str]],
+            search_results: List[SnapshotInfo],
+    ) -> MatchedSource:
+        snapshot = snapshot_info.snapshot
+        new_source = NewSource.from_snapshot(snapshot, match_info.site_user_id)
+        hash_names = dict(zip(self.hash_id_priority, self.hash_priority))
+        # Perceptual hashes are searched first, but the snapshot's own hashes say whether it's an exact match too
+        snapshot_hashes = {
+            (file_hash["algo_id"], file_hash["hash_value"])
+            for file in snapshot["submission_data"]["files"]
+            for file_hash in file["file_hashes"]
+        }
+        exact_algos = sorted(hash_names[algo_id] for algo_id, _ in post_exact_hashes & snapshot_hashes)
+        if exact_algos:
+            match_algo, match_distance = exact_algos[0], 0
+        else:
+            match_algo, match_distance = hash_names[hash_id], snapshot.get("hash_distance", 0)
+        uploader_id = snapshot_info.uploader_id
+        uploader_match = (
+            match_info.site_user_id is not None
+            and uploader_id is not None
+            and match_info.site_user_id.lower() == uploader_id.lower()
+        )
+        candidate_count = sum(1 for result in search_results if match_info.might_match(result))
+        return MatchedSource(new_source, match_algo, match_distance, uploader_match, candidate_count)
+
+    def should_auto_approve(self, matched_source: MatchedSource) -> bool:
+        # Only exact file matches, posted by the user the e621 post credits, with no other possible match
+        return (
+            self.auto_approve
+            and matched_source.is_exact
+            and matched_source.uploader_match
+            and matched_source.candidate_count == 1
+        )
+
+    def find_matching_source(self, post_id: str, post_issues: PostIssues) -> List[MatchedSource]:
+        faxdb_post_data = self.faexportdb.view_submission("e621", post_id)
+        if "data" not in faxdb_post_data:
+            print(f"faexportdb has no data for post {post_to_url('e621', post_id)}")
+            return []
         post_hashes = faxdb_post_data["data"]["submission_data"]["files"][0]["file_hashes"]
-        remaining_match_infos = post_issues.unique_match_info()
+        exact_hash_ids = {
+            algo_id for algo_id, algo_name in zip(self.hash_id_priority, self.hash_priority)
+            if algo_name in EXACT_HASH_ALGOS
+        }
+        post_exact_hashes = {
+            (file_hash["algo_id"], file_hash["hash_value"])
+            for file_hash in post_hashes if file_hash["algo_id"] in exact_hash_ids
+        }
+        match_index = post_issues.match_index()
         new_sources = []
         e6_link = post_to_url("e621", post_id)
         for hash_id in self.hash_id_priority:
+            if not match_index:
+                break
             value = next(iter(
                 [file_hash["hash_value"] for file_hash in post_hashes if file_hash["algo_id"] == hash_id]
             ), None)
             if not value:
                 continue
-            matching_results = requests.post(
-                "https://faexportdb.spangle.org.uk/api/hash_search/",
-                json={
-                    "algo_id": hash_id,
-                    "hash_value": value,
-                }
-            ).json()
+            matching_results = self.faexportdb.hash_search(hash_id, value)
+            snapshot_infos = []
             for snapshot in matching_results["results"]:
                 if snapshot["website_id"] == "e621":
                     if snapshot["site_submission_id"] == post_id:
@@ -106,24 +175,107 @@ class PostFixer:
                     other_e6_link = post_to_url("e621", snapshot["site_submission_id"])
                     print(f"Another post ({other_e6_link}) on e621 matches hash of post: {e6_link}")
                     continue
-                for match_info in remaining_match_infos[:]:
-                    if match_info.might_match_snapshot(snapshot):
-                        remaining_match_infos.remove(match_info)
-                        new_source = NewSource.from_snapshot(snapshot, match_info.site_user_id)
-                        new_sources.append(new_source)
-                        print(f"Found a potential source for post: {e6_link}, {new_source.submission_link}")
-        if remaining_match_infos:
+                snapshot_infos.append(SnapshotInfo.from_snapshot(snapshot))
+            for snapshot_info in snapshot_infos:
+                for match_info in match_index.pop_matches(snapshot_info):
+                    matched_source = self.describe_match(
+                        snapshot_info, match_info, hash_id, post_exact_hashes, snapshot_infos
+                    )
+                    new_sources.append(matched_source)
+                    print(
+                        f"Found a potential source for post: {e6_link}, "
+                        f"{matched_source.new_source.submission_link} "
+                        f"({matched_source.match_algo}, distance {matched_source.match_distance})"
+                    )
+        if match_index:
             print(f"Can't find any matches for post {e6_link}")
         return new_sources
 
+    def save_batch(self, results: List[Tuple[str, List[MatchedSource]]]) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        review_sources = []
+        with self.db.transaction():
+            self.db.add_posts([post_id for post_id, _ in results], now)
+            for post_id, matched_sources in results:
+                approved_links = []
+                for matched in matched_sources:
+                    new_source = matched.new_source
+                    if not self.should_auto_approve(matched):
+                        review_sources.append((
+                            post_id, new_source.submission_link, new_source.direct_link,
+                            matched.match_algo, matched.match_distance
+                        ))
+                        continue
+                    if self.db.add_auto_approved_source(
+                            post_id, new_source.submission_link, new_source.direct_link,
+                            matched.match_algo, matched.match_distance
+                    ):
+                        approved_links.extend(new_source.source_links())
+                if approved_links:
+                    # The web app's outbox worker sends these on to e621
+                    self.db.add_outbox_entry(post_id, approved_links)
+                    self.auto_approved_count += 1
+            self.db.add_new_sources(review_sources)
+
+    def save_results(self, results: Iterable[Tuple[str, List[MatchedSource]]]) -> None:
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= self.write_batch_size:
+                self.save_batch(batch)
+                batch = []
+        if batch:
+            self.save_batch(batch)
+
+    def skip_checked(
+            self,
+            posts: Iterable[Tuple[str, List[FixableSourceMatch]]]
+    ) -> Iterator[Tuple[str, List[FixableSourceMatch]]]:
+        # Posts without a match are only retried after no_match_recheck_age, to give faexportdb time to get new data
+        now = datetime.datetime.now(datetime.timezone.utc)
+        matched_since = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        if self.recheck_age is not None:
+            matched_since = now - self.recheck_age
+        checked_post_ids = self.db.get_recently_checked_post_ids(matched_since, now - self.no_match_recheck_age)
+        print(f"Skipping {len(checked_post_ids)} recently checked posts")
+        for post_id, matches in posts:
+            if post_id not in checked_post_ids:
+                yield post_id, matches
+
+    def iter_lookups(
+            self,
+            posts: Iterable[Tuple[str, List[FixableSourceMatch]]]
+    ) -> Iterator[Tuple[str, List[MatchedSource]]]:
+        # Fetch hash priorities up front, rather than having every lookup thread race to fetch them
+        _ = self.hash_id_priority
+        # Lookups run concurrently, but results come out in order, with a bounded number of posts in flight
+        in_flight: Deque[Tuple[str, Future]] = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for post_id, matches in posts:
+                post_issues = PostIssues(matches)
+                in_flight.append((post_id, executor.submit(self.find_matching_source, post_id, post_issues)))
+                if len(in_flight) >= self.concurrency * 2:
+                    done_post_id, future = in_flight.popleft()
+                    yield done_post_id, future.result()
+            while in_flight:
+                done_post_id, future = in_flight.popleft()
+                yield done_post_id, future.result()
+
     def fix_sources(self, match_dict: Dict[str, List[FixableSourceMatch]]) -> None:
-        for post_id, matches in tqdm.tqdm(match_dict.items(), desc="Finding source matches"):
-            post_issues = PostIssues(matches)
-            new_sources = self.find_matching_source(post_id, post_issues)
-            now = datetime.datetime.now(datetime.timezone.utc)
-            self.db.add_post(post_id, now)
-            for new_source in new_sources:
-                self.db.add_new_source(post_id, new_source.submission_link, new_source.direct_link)
+        posts = tqdm.tqdm(match_dict.items(), desc="Finding source matches")
+        self.save_results(self.iter_lookups(self.skip_checked(posts)))
+        print(f"Auto-approved exact matches for {self.auto_approved_count} posts")
+        print(self.faexportdb.cache_report())
+
+    def fix_sources_streaming(
+            self,
+            posts: Iterable[Tuple[str, List[FixableSourceMatch]]],
+            queue_size: int = 1000
+    ) -> None:
+        pipeline = Pipeline(queue_size)
+        pipeline.run(self.skip_checked(posts), self.iter_lookups, self.save_results)
+        print(f"Auto-approved exact matches for {self.auto_approved_count} posts")
+        print(self.faexportdb.cache_report())
 
 
 if __name__ == "__main__":
@@ -138,13 +290,38 @@ if __name__ == "__main__":
         TwitterGallery(),
         TwitterDirectLink(),
     ]
-    m_dict = scan_csv(path, checkers)
     api = E621API(
         "e621_gallery_finder/1.0.0 (by dr-spangle on e621)",
         "dr-spangle",
         config["e621_api_key"]
     )
     db_obj = Database()
-    fixer = PostFixer(api, db_obj)
-    fixer.fix_sources(m_dict)
+    lookup_concurrency = config.get("lookup_concurrency", 10)
+    if "hash_index_snapshots" in config:
+        faexportdb_client = LocalHashIndex.load(
+            config["hash_index_snapshots"],
+            config["hash_index_algos"],
+            config.get("hash_index_max_distance", 0),
+        )
+    else:
+        response_cache = ResponseCache(
+            DEFAULT_CACHE_TTLS,
+            max_bytes=config.get("faexportdb_cache_max_mb", 1024) * 1024 ** 2
+        )
+        faexportdb_client = FAExportDB(
+            config.get("faexportdb_url", "https://faexportdb.spangle.org.uk"),
+            lookup_concurrency,
+            response_cache,
+        )
+    recheck_days = config.get("recheck_days")
+    fixer = PostFixer(
+        api,
+        db_obj,
+        faexportdb_client,
+        lookup_concurrency,
+        datetime.timedelta(days=recheck_days) if recheck_days is not None else None,
+        datetime.timedelta(days=config.get("no_match_recheck_days", 30)),
+        auto_approve=config.get("auto_approve_exact_matches", True),
+    )
+    fixer.fix_sources_streaming(iter_matches(path, checkers), config.get("pipeline_queue_size", 1000))
 
@@ -45,6 +45,22 @@ class NewSource:
         return cls(submission_url, direct_link)
 
 
+EXACT_HASH_ALGOS = {"any:md5", "any:sha256"}
+
+
+@dataclasses.dataclass
+class MatchedSource:
+    new_source: NewSource
+    match_algo: str
+    match_distance: int
+    uploader_match: bool
+    candidate_count: int
+
+    @property
+    def is_exact(self) -> bool:
+        return self.match_algo in EXACT_HASH_ALGOS and self.match_distance == 0
+
+
 @dataclasses.dataclass
 class PostStatusEntry:
     post_id: str
@@ -70,12 +86,34 @@ class PostStatusEntry:
         }
 
 
+@dataclasses.dataclass
+class CachedPost:
+    post_id: str
+    file_url: Optional[str]
+    sources: List[str]
+    fetched_at: datetime.datetime
+
+    @classmethod
+    def from_api(cls, post_data: Dict, fetched_at: datetime.datetime) -> "CachedPost":
+        return cls(str(post_data["id"]), post_data["file"]["url"], post_data["sources"], fetched_at)
+
+
+@dataclasses.dataclass
+class OutboxEntry:
+    outbox_id: int
+    post_id: str
+    source_links: List[str]
+    attempts: int
+
+
 @dataclasses.dataclass
 class NewSourceEntry(NewSource):
     source_id: int
     checked: bool
     approved: Optional[bool]
-    
+    match_algo: Optional[str] = None
+    match_distance: Optional[int] = None
+
     @property
     def direct_link_fallback(self) -> Optional[str]:
         if self.direct_link is None:
@@ -89,5 +127,24 @@ class NewSourceEntry(NewSource):
             "direct_link_fallback": self.direct_link_fallback,
             "source_id": self.source_id,
             "checked": self.checked,
-            "approved": self.approved
+            "approved": self.approved,
+            "match_algo": self.match_algo,
+            "match_distance": self.match_distance,
+        }
+
+
+@dataclasses.dataclass
+class ReviewEntry:
+    post_status: PostStatusEntry
+    new_sources: List[NewSourceEntry]
+    direct_link: Optional[str]
+
+    def to_json(self) -> Dict:
+        post_status_json = self.post_status.to_json()
+        post_status_json["direct_link"] = self.direct_link
+        return {
+            "post_status": post_status_json,
+            "new_sources": [
+                new_source.to_json() for new_source in self.new_sources
+            ]
         }
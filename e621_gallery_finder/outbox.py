@@ -0,0 +1,69 @@
+import datetime
+import threading
+from typing import Optional
+
+from e621_gallery_finder.database import Database
+from e621_gallery_finder.post_cache import PostCache
+
+
+class OutboxWorker:
+    """
+    Applies approved sources to e621 in the background, from the outbox table.
+    Failed edits are retried with exponential backoff, until max_attempts is reached.
+    """
+
+    def __init__(
+            self,
+            db: Database,
+            post_cache: PostCache,
+            batch_size: int = 20,
+            poll_interval: float = 10,
+            max_attempts: int = 8,
+    ) -> None:
+        self.db = db
+        self.post_cache = post_cache
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.wake = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name="outbox_worker", daemon=True)
+        self.thread.start()
+
+    def notify(self) -> None:
+        self.wake.set()
+
+    def retry_time(self, attempts: int) -> Optional[datetime.datetime]:
+        if attempts + 1 >= self.max_attempts:
+            return None
+        backoff = datetime.timedelta(minutes=min(2 ** attempts, 360))
+        return datetime.datetime.now(datetime.timezone.utc) + backoff
+
+    def process_due(self) -> int:
+        entries = self.db.get_due_outbox_entries(self.batch_size)
+        if not entries:
+            return 0
+        # Fetch current sources for the whole batch in one API call
+        self.post_cache.get_posts([entry.post_id for entry in entries])
+        for entry in entries:
+            try:
+                self.post_cache.add_new_sources(entry.post_id, entry.source_links)
+            except Exception as e:
+                print(f"Failed to add sources to post {entry.post_id}: {e}")
+                self.db.update_outbox_failure(entry.outbox_id, str(e), self.retry_time(entry.attempts))
+                continue
+            self.db.update_outbox_done(entry.outbox_id)
+        return len(entries)
+
+    def run(self) -> None:
+        while True:
+            try:
+                processed = self.process_due()
+            except Exception as e:
+                print(f"Outbox worker failed to process entries: {e}")
+                processed = 0
+            if not processed:
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
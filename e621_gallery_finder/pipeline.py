@@ -0,0 +1,101 @@
+import dataclasses
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, Callable, Any, List, Optional
+
+_DONE = object()
+
+
+@dataclasses.dataclass
+class StageStats:
+    name: str
+    input_queue: Optional[queue.Queue] = None
+    processed: int = 0
+    started: float = dataclasses.field(default_factory=time.monotonic)
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        if elapsed <= 0:
+            return 0
+        return self.processed / elapsed
+
+    def report(self) -> str:
+        backlog = ""
+        if self.input_queue is not None:
+            backlog = f", backlog: {self.input_queue.qsize()}/{self.input_queue.maxsize}"
+        return f"{self.name}: {self.processed} done ({self.rate:.1f}/s{backlog})"
+
+
+def _counted(items: Iterable[Any], stats: StageStats) -> Iterator[Any]:
+    for item in items:
+        yield item
+        stats.processed += 1
+
+
+def _iter_queue(input_queue: queue.Queue) -> Iterator[Any]:
+    while True:
+        item = input_queue.get()
+        if item is _DONE:
+            return
+        yield item
+
+
+class Pipeline:
+    """
+    Runs the scan, lookup and write stages of the gallery finder at the same time, connected by bounded queues.
+    Lookups start as soon as the first matching post is scanned, and a slow stage holds back the stages before it,
+    rather than letting the queues grow without limit.
+    """
+
+    def __init__(self, queue_size: int = 1000, report_interval: float = 30) -> None:
+        self.scan_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.report_interval = report_interval
+        self.stats = [
+            StageStats("scan"),
+            StageStats("lookup", self.scan_queue),
+            StageStats("write", self.write_queue),
+        ]
+        self.errors: List[Exception] = []
+        self.finished = threading.Event()
+
+    def _feed(self, items: Iterable[Any], output_queue: queue.Queue, stats: StageStats) -> None:
+        try:
+            for item in _counted(items, stats):
+                output_queue.put(item)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            output_queue.put(_DONE)
+
+    def _monitor(self) -> None:
+        while not self.finished.wait(self.report_interval):
+            print("Pipeline: " + ". ".join(stats.report() for stats in self.stats))
+
+    def run(
+            self,
+            items: Iterable[Any],
+            lookup: Callable[[Iterable[Any]], Iterable[Any]],
+            write: Callable[[Iterable[Any]], None],
+    ) -> None:
+        scan_stats, lookup_stats, write_stats = self.stats
+        threads = [
+            threading.Thread(target=self._feed, args=(items, self.scan_queue, scan_stats), daemon=True),
+            threading.Thread(
+                target=self._feed,
+                args=(lookup(_iter_queue(self.scan_queue)), self.write_queue, lookup_stats),
+                daemon=True,
+            ),
+            threading.Thread(target=self._monitor, daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            write(_counted(_iter_queue(self.write_queue), write_stats))
+        finally:
+            self.finished.set()
+        print("Pipeline finished: " + ". ".join(stats.report() for stats in self.stats))
+        if self.errors:
+            raise self.errors[0]
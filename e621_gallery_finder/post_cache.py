@@ -0,0 +1,62 @@
+import datetime
+from typing import List, Dict, Optional
+
+from e621_gallery_finder.database import Database
+from e621_gallery_finder.e621_api import E621API
+from e621_gallery_finder.new_source import CachedPost
+
+
+class PostCache:
+    """
+    Keeps e621 post metadata in the database, so that pages of the review UI don't need to go to the e621 API for
+    posts which were fetched recently.
+    """
+
+    def __init__(self, api: E621API, db: Database, ttl: datetime.timedelta = datetime.timedelta(hours=6)) -> None:
+        self.api = api
+        self.db = db
+        self.ttl = ttl
+
+    def get_posts(self, post_ids: List[str]) -> Dict[str, CachedPost]:
+        post_ids = [str(post_id) for post_id in post_ids]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        posts = self.db.get_cached_posts(post_ids, now - self.ttl)
+        missing_ids = [post_id for post_id in post_ids if post_id not in posts]
+        if missing_ids:
+            api_resp = self.api.get_posts(missing_ids)
+            fetched = [CachedPost.from_api(post_data, now) for post_data in api_resp["posts"]]
+            self.db.save_cached_posts(fetched)
+            posts.update({post.post_id: post for post in fetched})
+        return posts
+
+    def get_post(self, post_id: str) -> Optional[CachedPost]:
+        return self.get_posts([post_id]).get(str(post_id))
+
+    def refresh_post(self, post_id: str) -> Optional[CachedPost]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        api_resp = self.api.get_posts([post_id])
+        fetched = [CachedPost.from_api(post_data, now) for post_data in api_resp["posts"]]
+        self.db.save_cached_posts(fetched)
+        return next(iter(fetched), None)
+
+    def add_new_sources(self, post_id: str, new_source_links: List[str]) -> None:
+        post = self.get_post(post_id)
+        if post is not None and set(new_source_links) & set(post.sources):
+            # Links are only left out of an edit on the word of a fresh copy, in case they were removed since it was
+            # cached. If the cache has none of them, all are sent anyway, so the cached copy is safe to use
+            post = self.refresh_post(post_id)
+        current_sources = post.sources if post is not None else None
+        resp = self.api.add_new_sources(post_id, new_source_links, current_sources)
+        if resp is None:
+            return
+        if "post" in resp:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            self.db.save_cached_posts([CachedPost.from_api(resp["post"], now)])
+        else:
+            self.db.remove_cached_post(str(post_id))
+
+    def add_new_sources_many(self, new_sources_by_post: Dict[str, List[str]]) -> None:
+        # Prefetch current sources for all the posts at once, rather than one call per post
+        self.get_posts(list(new_sources_by_post.keys()))
+        for post_id, new_source_links in new_sources_by_post.items():
+            self.add_new_sources(post_id, new_source_links)
@@ -1,7 +1,60 @@
 import dataclasses
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set, Tuple
 
-from e621_gallery_finder.source_checks import FixableSourceMatch, MatchInfo
+from e621_gallery_finder.source_checks import FixableSourceMatch, MatchInfo, SnapshotInfo
+
+
+class MatchIndex:
+    """
+    Index of a post's match infos which haven't been matched to a snapshot yet. Match infos are keyed by site and
+    user ID, and by site and direct image link, so that the ones which might match a snapshot can be looked up from
+    the snapshot's uploader and file URLs, rather than checking each one in turn.
+    """
+
+    def __init__(self, match_infos: List[MatchInfo]) -> None:
+        self.match_infos: Dict[int, MatchInfo] = dict(enumerate(match_infos))
+        self.by_site: Dict[str, Set[int]] = {}
+        self.by_user: Dict[Tuple[str, Optional[str]], Set[int]] = {}
+        self.by_direct_link: Dict[Tuple[str, Optional[str]], Set[int]] = {}
+        for num, match_info in self.match_infos.items():
+            self.by_site.setdefault(match_info.site_id, set()).add(num)
+            self.by_user.setdefault((match_info.site_id, match_info.site_user_id), set()).add(num)
+            self.by_direct_link.setdefault((match_info.site_id, match_info.direct_image_link), set()).add(num)
+
+    def __len__(self) -> int:
+        return len(self.match_infos)
+
+    def _candidates(self, snapshot_info: SnapshotInfo) -> Set[int]:
+        site_id = snapshot_info.site_id
+        site_nums = self.by_site.get(site_id, set())
+        if not site_nums:
+            return set()
+        # Match infos without a user ID or direct link can match any snapshot on the site
+        user_nums = site_nums
+        if snapshot_info.uploader_id is not None:
+            user_nums = (
+                self.by_user.get((site_id, snapshot_info.uploader_id), set())
+                | self.by_user.get((site_id, None), set())
+            )
+        link_nums = site_nums
+        if snapshot_info.file_urls:
+            link_nums = set(self.by_direct_link.get((site_id, None), set()))
+            for file_url in snapshot_info.file_urls:
+                link_nums |= self.by_direct_link.get((site_id, file_url), set())
+        return user_nums & link_nums
+
+    def pop_matches(self, snapshot_info: SnapshotInfo) -> List[MatchInfo]:
+        """
+        Removes and returns, in their original order, all the remaining match infos which might match the snapshot.
+        """
+        matches = []
+        for num in sorted(self._candidates(snapshot_info)):
+            match_info = self.match_infos.pop(num)
+            self.by_site[match_info.site_id].discard(num)
+            self.by_user[(match_info.site_id, match_info.site_user_id)].discard(num)
+            self.by_direct_link[(match_info.site_id, match_info.direct_image_link)].discard(num)
+            matches.append(match_info)
+        return matches
 
 
 @dataclasses.dataclass
@@ -10,7 +63,9 @@ class PostIssues:
 
     @property
     def all_match_info(self) -> List[MatchInfo]:
-        return sum([source_issue.imprecise_matches for source_issue in self.source_issues], start=[])
+        return [
+            match_info for source_issue in self.source_issues for match_info in source_issue.imprecise_matches
+        ]
 
     def unique_match_info_by_site(self) -> Dict[str, List[MatchInfo]]:
         match_dict = {}
@@ -37,7 +92,7 @@ class PostIssues:
                         if match_info.direct_image_link is not None:
                             username_known[match_info.site_user_id] = match_info
             site_matches = list(username_known.values())
-            username_known_direct_links = [match_info.direct_image_link for match_info in username_known.values()]
+            username_known_direct_links = {match_info.direct_image_link for match_info in username_known.values()}
             for match_info in direct_only.values():
                 if match_info.direct_image_link not in username_known_direct_links:
                     site_matches.append(match_info)
@@ -47,4 +102,9 @@ class PostIssues:
         return unique_site_dict
 
     def unique_match_info(self) -> List[MatchInfo]:
-        return sum(self.unique_match_info_by_site().values(), start=[])
+        return [
+            match_info for site_matches in self.unique_match_info_by_site().values() for match_info in site_matches
+        ]
+
+    def match_index(self) -> MatchIndex:
+        return MatchIndex(self.unique_match_info())
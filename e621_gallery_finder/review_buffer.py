@@ -0,0 +1,93 @@
+import collections
+import datetime
+import threading
+from typing import List, Optional, Set, Deque
+
+from e621_gallery_finder.database import Database, ReviewCursor
+from e621_gallery_finder.image_cache import ImageCache
+from e621_gallery_finder.new_source import ReviewEntry
+from e621_gallery_finder.post_cache import PostCache
+
+
+class ReviewBuffer:
+    """
+    Keeps the next entries of the review queue in memory, with their e621 file URLs already looked up, so that pages
+    of the queue can be handed out to reviewers without waiting on the database or the e621 API.
+    Entries are only claimed for a reviewer as they are taken, and any which have been claimed or reviewed elsewhere
+    in the meantime are dropped.
+    """
+
+    def __init__(
+            self,
+            db: Database,
+            post_cache: PostCache,
+            size: int = 200,
+            refill_interval: float = 30,
+            image_cache: Optional[ImageCache] = None,
+    ) -> None:
+        self.db = db
+        self.post_cache = post_cache
+        self.image_cache = image_cache
+        self.size = size
+        self.refill_interval = refill_interval
+        self.entries: Deque[ReviewEntry] = collections.deque()
+        self.buffered_ids: Set[str] = set()
+        self.cursor: Optional[ReviewCursor] = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name="review_buffer", daemon=True)
+        self.thread.start()
+
+    def take(self, reviewer: str, count: int, lease: datetime.timedelta) -> List[ReviewEntry]:
+        taken = []
+        with self.lock:
+            while len(taken) < count and self.entries:
+                candidates = [self.entries.popleft() for _ in range(min(count - len(taken), len(self.entries)))]
+                for entry in candidates:
+                    self.buffered_ids.discard(entry.post_status.post_id)
+                claimed = self.db.claim_posts(reviewer, [entry.post_status.post_id for entry in candidates], lease)
+                taken.extend(entry for entry in candidates if entry.post_status.post_id in claimed)
+            if len(self.entries) < self.size // 2:
+                self.wake.set()
+        return taken
+
+    def refill(self) -> bool:
+        page, cursor = self.db.get_review_page(self.size - len(self.entries), self.cursor)
+        if not page:
+            # Reached the end of the queue, so start again from the top, to pick up skipped and released posts
+            self.cursor = None
+            return False
+        self.cursor = cursor
+        page = [
+            (post_status, new_sources) for post_status, new_sources in page
+            if post_status.post_id not in self.buffered_ids
+        ]
+        cached_posts = self.post_cache.get_posts([post_status.post_id for post_status, _ in page])
+        new_entries = []
+        for post_status, new_sources in page:
+            cached_post = cached_posts.get(post_status.post_id)
+            new_entries.append(ReviewEntry(post_status, new_sources, cached_post.file_url if cached_post else None))
+        with self.lock:
+            for entry in new_entries:
+                self.entries.append(entry)
+                self.buffered_ids.add(entry.post_status.post_id)
+        if self.image_cache is not None:
+            image_links = []
+            for entry in new_entries:
+                image_links.append(entry.direct_link)
+                image_links.extend(new_source.direct_link for new_source in entry.new_sources)
+            self.image_cache.prefetch(image_links)
+        return True
+
+    def run(self) -> None:
+        while True:
+            try:
+                while len(self.entries) < self.size and self.refill():
+                    pass
+            except Exception as e:
+                print(f"Failed to refill review buffer: {e}")
+            self.wake.wait(self.refill_interval)
+            self.wake.clear()
@@ -1,10 +1,28 @@
 import dataclasses
 from abc import abstractmethod
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Set
 
 from e621_source_cleanup.checks.base import BaseCheck, SourceURL, SourceMatch
 
 
+@dataclasses.dataclass
+class SnapshotInfo:
+    snapshot: Dict
+    site_id: str
+    uploader_id: Optional[str]
+    file_urls: Set[str]
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict) -> "SnapshotInfo":
+        submission_data = snapshot["submission_data"]
+        return cls(
+            snapshot,
+            snapshot["website_id"],
+            submission_data["uploader_site_user_id"],
+            {file["file_url"] for file in submission_data["files"] if file["file_url"] is not None},
+        )
+
+
 @dataclasses.dataclass
 class MatchInfo:
     source: SourceURL
@@ -14,12 +32,15 @@ class MatchInfo:
     direct_image_link: Optional[str] = None
 
     def might_match_snapshot(self, snapshot: Dict) -> bool:
-        if snapshot["website_id"] != self.site_id:
+        return self.might_match(SnapshotInfo.from_snapshot(snapshot))
+
+    def might_match(self, snapshot_info: SnapshotInfo) -> bool:
+        if snapshot_info.site_id != self.site_id:
             return False
-        uploader_id = snapshot["submission_data"]["uploader_site_user_id"]
+        uploader_id = snapshot_info.uploader_id
         if self.site_user_id is not None and uploader_id is not None and self.site_user_id != uploader_id:
             return False
-        file_urls = [file["file_url"] for file in snapshot["submission_data"]["files"] if file["file_url"] is not None]
+        file_urls = snapshot_info.file_urls
         if self.direct_image_link is not None and file_urls and self.direct_image_link not in file_urls:
             return False
         return True
@@ -30,7 +51,8 @@ class FixableSourceMatch(SourceMatch):
     imprecise_matches: List[MatchInfo]
 
     def match_snapshot(self, snapshot: Dict) -> bool:
-        return all(match_info.might_match_snapshot(snapshot) for match_info in self.imprecise_matches)
+        snapshot_info = SnapshotInfo.from_snapshot(snapshot)
+        return all(match_info.might_match(snapshot_info) for match_info in self.imprecise_matches)
 
 
 class IncompleteSourceCheck(BaseCheck):
@@ -2,14 +2,19 @@ import base64
 import dataclasses
 import datetime
 import json
+import uuid
 from pathlib import Path
 from typing import Tuple, List, Optional
 
 import flask
 
-from e621_gallery_finder.database import Database
+from e621_gallery_finder.database import Database, review_cursor
 from e621_gallery_finder.e621_api import E621API
-from e621_gallery_finder.new_source import NewSource, NewSourceEntry, PostStatusEntry
+from e621_gallery_finder.image_cache import ImageCache, UnsupportedImage
+from e621_gallery_finder.new_source import NewSource, NewSourceEntry, PostStatusEntry, ReviewEntry
+from e621_gallery_finder.outbox import OutboxWorker
+from e621_gallery_finder.post_cache import PostCache
+from e621_gallery_finder.review_buffer import ReviewBuffer
 
 
 templates_dir = Path(__file__).parent / "templates"
@@ -19,21 +24,42 @@ db = Database()
 config_path = "./config.json"
 with open(config_path, "r") as conf_file:
     config = json.load(conf_file)
+USER_AGENT = "e621_gallery_finder/1.0.0 (by dr-spangle on e621)"
 api = E621API(
-    "e621_gallery_finder/1.0.0 (by dr-spangle on e621)",
+    USER_AGENT,
     "dr-spangle",
     config["e621_api_key"]
 )
+post_cache = PostCache(api, db, datetime.timedelta(hours=config.get("post_cache_hours", 6)))
+outbox_worker = OutboxWorker(db, post_cache)
+outbox_worker.start()
+image_cache = ImageCache(
+    USER_AGENT,
+    config.get("image_cache_dir"),
+    max_bytes=config.get("image_cache_max_mb", 2048) * 1024 ** 2,
+    allowed_origins=config.get("image_cache_allowed_origins"),
+)
+review_buffer = ReviewBuffer(db, post_cache, config.get("review_buffer_size", 200), image_cache=image_cache)
+review_buffer.start()
 
 AUTH_KEY = config["web_auth_key"]
+IMAGE_MAX_AGE = 86400 * 30
+REVIEW_LEASE = datetime.timedelta(minutes=config.get("review_lease_minutes", 30))
 
 
 @app.route('/')
 def hello():
+    outbox_counts = db.count_outbox_by_status()
+    source_stats = db.get_source_stats()
     return flask.render_template(
         "home.html",
-        unchecked_sources=db.count_unchecked_sources(),
-        total_sources=db.count_total_sources(),
+        unchecked_sources=source_stats.get("unchecked", 0),
+        total_sources=source_stats.get("total", 0),
+        approved_sources=source_stats.get("approved", 0),
+        rejected_sources=source_stats.get("rejected", 0),
+        daily_stats=db.get_daily_source_stats(config.get("dashboard_days", 7)),
+        outbox_pending=outbox_counts.get("pending", 0),
+        outbox_failed=outbox_counts.get("failed", 0),
     )
 
 
@@ -51,17 +77,56 @@ def login_post():
         return "Invalid auth token"
     resp = flask.make_response("Logged in")
     resp.set_cookie("auth_key", auth_key, max_age=86400*100)
+    resp.set_cookie("reviewer_id", get_reviewer_id(), max_age=86400*100)
     return resp
 
 
-def get_next_post() -> Optional[Tuple[PostStatusEntry, List[NewSourceEntry]]]:
-    new_data = db.get_next_unchecked_sources()
+def get_reviewer_id() -> str:
+    # Everyone shares the auth key, so each browser gets its own ID to claim posts from the queue with
+    return flask.request.cookies.get("reviewer_id") or uuid.uuid4().hex
+
+
+def get_next_post(reviewer_id: str) -> Optional[Tuple[PostStatusEntry, List[NewSourceEntry]]]:
+    new_data, _ = db.claim_review_page(reviewer_id, 1, REVIEW_LEASE)
     if not new_data:
         return None
-    post_status, new_sources = next_data[0]
+    post_status, new_sources = new_data[0]
     return post_status, new_sources
 
 
+DECISION_MESSAGES = {
+    "skip": "Post skipped.",
+    "no_match": "Marked sources as no match.",
+    "match_all": "Queued source links to be added to e621 post.",
+}
+
+
+def apply_decision(post_id: str, source_ids: List[int], action: str) -> bool:
+    """
+    Records a reviewer's decision on a post, and returns whether an edit was queued to be sent to e621.
+    Raises ValueError, before changing anything, if the action is unknown or the sources don't belong to the post.
+    """
+    if action not in DECISION_MESSAGES:
+        raise ValueError(f"Unrecognised action: {action}")
+    sources = {}
+    if action != "skip":
+        sources = db.get_sources(source_ids, post_id)
+        unknown_ids = [str(source_id) for source_id in source_ids if source_id not in sources]
+        if unknown_ids:
+            raise ValueError(f"Sources {', '.join(unknown_ids)} do not belong to post {post_id}")
+    db.release_claims([post_id])
+    if action == "skip":
+        db.update_post_skip(post_id, datetime.datetime.now(datetime.timezone.utc))
+        return False
+    if action == "no_match":
+        db.update_sources_approved(source_ids, False)
+        return False
+    source_links = [link for source_id in source_ids for link in sources[source_id].source_links()]
+    db.add_outbox_entry(post_id, source_links)
+    db.update_sources_approved(source_ids, True)
+    return True
+
+
 @app.route("/check", methods=["POST"])
 def record_match():
     if flask.request.cookies["auth_key"] != AUTH_KEY:
@@ -69,52 +134,76 @@ def record_match():
     post_id = flask.request.form["post_id"]
     source_ids = [int(x) for x in flask.request.form["source_ids"].split(",")]
     action = flask.request.form["action"]
-    if action == "skip":
-        db.update_post_skip(post_id, datetime.datetime.now(datetime.timezone.utc))
-        return flask.render_template(
-            "check_post.html",
-            message="Post skipped.",
-            post_id=post_id,
-        )
-    if action == "no_match":
-        for source_id in source_ids:
-            db.update_source_approved(source_id, False)
-        return flask.render_template(
-            "check_post.html",
-            message="Marked sources as no match.",
-            post_id=post_id,
-        )
-    if action == "match_all":
-        sources = []
-        for source_id in source_ids:
-            sources.append(db.get_source(source_id))
-        source_links = sum([source.source_links() for source in sources], start=[])
-        api.add_new_sources(post_id, source_links)
-        for source_id in source_ids:
-            db.update_source_approved(source_id, True)
-        return flask.render_template(
-            "check_post.html",
-            message="Added source links for e621 post.",
-            post_id=post_id,
-        )
+    try:
+        with db.transaction():
+            queued_edit = apply_decision(post_id, source_ids, action)
+    except ValueError as e:
+        return f"Invalid decision: {e}", 400
+    if queued_edit:
+        outbox_worker.notify()
+    return flask.render_template(
+        "check_post.html",
+        message=DECISION_MESSAGES[action],
+        post_id=post_id,
+    )
+
+
+@app.route("/check_batch.json", methods=["POST"])
+def record_matches():
+    if flask.request.cookies["auth_key"] != AUTH_KEY:
+        return {
+            "error": {
+                "code": 403,
+                "message": "Not logged in"
+            }
+        }, 403
+    # Forced, as batches sent by the page as it closes can't set a JSON content type
+    decisions = flask.request.get_json(force=True)["decisions"]
+    # A bad decision is rejected on its own, rather than failing the rest of the batch with it
+    queued_edit = False
+    rejected = []
+    with db.transaction():
+        for decision in decisions:
+            try:
+                queued_edit |= apply_decision(
+                    str(decision["post_id"]),
+                    [int(source_id) for source_id in decision["source_ids"]],
+                    decision["action"],
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                rejected.append({
+                    "post_id": decision.get("post_id") if isinstance(decision, dict) else None,
+                    "message": str(e) if isinstance(e, ValueError) else f"Malformed decision: {e!r}",
+                })
+    if queued_edit:
+        outbox_worker.notify()
+    return {
+        "data": {
+            "applied": len(decisions) - len(rejected),
+            "rejected": rejected,
+        }
+    }
 
 
 @app.route("/check")
 def check_match():
     if flask.request.cookies["auth_key"] != AUTH_KEY:
         return "Not logged in."
-    next_data = get_next_post()
+    reviewer_id = get_reviewer_id()
+    next_data = get_next_post(reviewer_id)
     if next_data is None:
         return "No more matches to check!"
     post_status, new_sources = next_data
-    post_resp = api.get_post(post_status.post_id)
-    post_direct_url = post_resp["post"]["file"]["url"]
-    return flask.render_template(
+    cached_post = post_cache.get_post(post_status.post_id)
+    post_direct_url = cached_post.file_url if cached_post else None
+    resp = flask.make_response(flask.render_template(
         "check.html",
         post_status=post_status,
         new_sources=new_sources,
         post_direct_url=post_direct_url,
-    )
+    ))
+    resp.set_cookie("reviewer_id", reviewer_id, max_age=86400*100)
+    return resp
 
 
 @app.route("/check_js")
@@ -136,26 +225,56 @@ def list_next():
             }
         }, 403
     count = int(flask.request.args.get("count", default=20))
-    results = []
-    new_data = db.get_next_unchecked_sources(count=count)
-    post_ids = [datum[0].post_id for datum in new_data]
-    api_resp = api.get_posts(post_ids)
-    direct_links = {
-        post["id"]: post["file"]["url"] for post in api_resp["posts"]
-    }
-    for post_status, new_sources in new_data:
-        post_status_json = post_status.to_json()
-        post_status_json["direct_link"] = direct_links[post_status.post_id]
-        results.append(
-            {
-                "post_status": post_status_json,
-                "new_sources": [
-                    new_source.to_json() for new_source in new_sources
-                ]
-            }
+    after = None
+    if "after" in flask.request.args:
+        after = tuple(json.loads(flask.request.args["after"]))
+    reviewer_id = get_reviewer_id()
+    entries = review_buffer.take(reviewer_id, count, REVIEW_LEASE)
+    if len(entries) < count:
+        # The buffer has run dry, so top up straight from the database. Posts this reviewer already holds have been
+        # handed out already, including the ones just taken from the buffer, so only unclaimed posts are wanted here
+        new_data, _ = db.claim_review_page(
+            reviewer_id, count - len(entries), REVIEW_LEASE, after, include_own_claims=False
         )
-    return {
+        if len(new_data) < count - len(entries) and after is not None:
+            # Reached the end of the queue, so start again from the top, to pick up skipped and released posts
+            new_data += db.claim_review_page(
+                reviewer_id, count - len(entries) - len(new_data), REVIEW_LEASE, include_own_claims=False
+            )[0]
+        cached_posts = post_cache.get_posts([datum[0].post_id for datum in new_data])
+        for post_status, new_sources in new_data:
+            cached_post = cached_posts.get(str(post_status.post_id))
+            entries.append(ReviewEntry(post_status, new_sources, cached_post.file_url if cached_post else None))
+    results = [entry.to_json() for entry in entries]
+    # The cursor is after the furthest post handed out, whether it came from the buffer or the database
+    next_cursor = max([review_cursor(entry.post_status) for entry in entries], default=after)
+    resp = flask.make_response({
         "data": {
-            "results": results
+            "results": results,
+            "next_cursor": next_cursor,
         }
-    }
+    })
+    resp.set_cookie("reviewer_id", reviewer_id, max_age=86400*100)
+    return resp
+
+
+@app.route("/image")
+def image_proxy():
+    if flask.request.cookies.get("auth_key") != AUTH_KEY:
+        return "Not logged in.", 403
+    url = flask.request.args["url"]
+    if not image_cache.is_allowed(url):
+        return "Image host not allowed.", 403
+    try:
+        data, content_type = image_cache.get(url)
+    except UnsupportedImage:
+        # Videos, flash, and very large files are left for the browser to load directly
+        return flask.redirect(url)
+    except Exception as e:
+        return f"Failed to fetch image: {e}", 502
+    resp = flask.make_response(data)
+    resp.mimetype = content_type
+    resp.cache_control.private = True
+    resp.cache_control.max_age = IMAGE_MAX_AGE
+    resp.set_etag(ImageCache.cache_key(url))
+    return resp.make_conditional(flask.request)
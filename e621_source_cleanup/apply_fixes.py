@@ -0,0 +1,177 @@
+import datetime
+import json
+import sqlite3
+from typing import Dict, Iterable, List, Tuple, Optional
+
+import tqdm
+
+from e621_gallery_finder.e621_api import E621API, RateLimiter
+from e621_source_cleanup.main import fetch_db_dump_path
+
+
+class EditJournal:
+    """
+    Records the status of each post edit, so that an interrupted run can resume without re-sending edits.
+    Edits are marked as sending before the request is made, so any edit left in that state after a crash has to be
+    verified against the site, rather than sent again. If that check fails, the edit is left unverified, and checked
+    again on the next run, rather than being retried.
+    """
+    PENDING = "pending"
+    SENDING = "sending"
+    UNVERIFIED = "unverified"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, journal_path: str) -> None:
+        self.conn = sqlite3.connect(journal_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS edits ("
+            "post_id str primary key, "
+            "replacements str not null, "
+            "status str not null, "
+            "attempts integer not null default 0, "
+            "error str, "
+            "updated_at date"
+            ")"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS edits_status ON edits (status)")
+        self.conn.commit()
+
+    def add_edits(self, edits: Iterable[Tuple[str, Dict[str, str]]], batch_size: int = 10_000) -> None:
+        batch = []
+        for post_id, replacements in edits:
+            batch.append((post_id, json.dumps(replacements), self.PENDING))
+            if len(batch) >= batch_size:
+                self._insert_edits(batch)
+                batch = []
+        if batch:
+            self._insert_edits(batch)
+
+    def _insert_edits(self, batch: List[Tuple[str, str, str]]) -> None:
+        # Existing rows are left alone, so that re-running with the same results keeps their status
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO edits (post_id, replacements, status) VALUES (?, ?, ?)",
+                batch
+            )
+
+    def set_status(self, post_id: str, status: str, error: Optional[str] = None) -> None:
+        with self.conn:
+            self.conn.execute(
+                "UPDATE edits SET status = ?, error = ?, updated_at = ?, "
+                "attempts = attempts + (CASE WHEN ? = 'sending' THEN 1 ELSE 0 END) "
+                "WHERE post_id = ?",
+                (status, error, datetime.datetime.now(datetime.timezone.utc), status, post_id)
+            )
+
+    def reset_unverified(self) -> None:
+        with self.conn:
+            self.conn.execute("UPDATE edits SET status = ? WHERE status = ?", (self.SENDING, self.UNVERIFIED))
+
+    def reset_failed(self, max_attempts: int) -> None:
+        with self.conn:
+            self.conn.execute(
+                "UPDATE edits SET status = ? WHERE status = ? AND attempts < ?",
+                (self.PENDING, self.FAILED, max_attempts)
+            )
+
+    def edits_with_status(self, status: str, count: int) -> List[Tuple[str, Dict[str, str]]]:
+        cur = self.conn.execute(
+            "SELECT post_id, replacements FROM edits WHERE status = ? LIMIT ?",
+            (status, count)
+        )
+        return [(row[0], json.loads(row[1])) for row in cur.fetchall()]
+
+    def count_by_status(self) -> Dict[str, int]:
+        cur = self.conn.execute("SELECT status, COUNT(*) FROM edits GROUP BY status")
+        return {row[0]: row[1] for row in cur.fetchall()}
+
+
+def load_fixes(results_path: str) -> Iterable[Tuple[str, Dict[str, str]]]:
+    with open(results_path, "r") as f:
+        results = json.load(f)
+    for post_id, matches in results.items():
+        replacements = {}
+        for match in matches:
+            if match["replacement"] and match["source"] not in replacements:
+                replacements[match["source"]] = match["replacement"]
+        if replacements:
+            yield post_id, replacements
+
+
+class FixApplier:
+
+    def __init__(self, api: E621API, journal: EditJournal, batch_size: int = 100, max_attempts: int = 3) -> None:
+        self.api = api
+        self.journal = journal
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+    def edit_applied(self, post_id: str, replacements: Dict[str, str]) -> bool:
+        resp = self.api.get_post(post_id)
+        if "post" not in resp:
+            raise Exception(f"E621 API responded with an error: {resp.get('reason', resp)}")
+        current_sources = set(resp["post"]["sources"])
+        for old_source, new_source in replacements.items():
+            if old_source in current_sources or new_source not in current_sources:
+                return False
+        return True
+
+    def recover_in_doubt(self) -> None:
+        # Edits which couldn't be checked last time get another check, but each is only checked once per run
+        self.journal.reset_unverified()
+        while in_doubt := self.journal.edits_with_status(EditJournal.SENDING, self.batch_size):
+            for post_id, replacements in in_doubt:
+                # A post which has since been deleted or hidden can't be checked, so it is set aside rather than
+                # blocking every later run, or being sent again without knowing whether the last attempt worked
+                try:
+                    applied = self.edit_applied(post_id, replacements)
+                except Exception as e:
+                    print(f"Failed to check sources for post {post_id}: {e}")
+                    self.journal.set_status(post_id, EditJournal.UNVERIFIED, str(e))
+                    continue
+                if applied:
+                    self.journal.set_status(post_id, EditJournal.DONE)
+                else:
+                    self.journal.set_status(post_id, EditJournal.PENDING)
+
+    def apply_edit(self, post_id: str, replacements: Dict[str, str]) -> None:
+        self.journal.set_status(post_id, EditJournal.SENDING)
+        try:
+            self.api.replace_sources(post_id, replacements)
+        except Exception as e:
+            print(f"Failed to update sources for post {post_id}: {e}")
+            self.journal.set_status(post_id, EditJournal.FAILED, str(e))
+            return
+        self.journal.set_status(post_id, EditJournal.DONE)
+
+    def apply_all(self) -> None:
+        self.recover_in_doubt()
+        self.journal.reset_failed(self.max_attempts)
+        total = self.journal.count_by_status().get(EditJournal.PENDING, 0)
+        with tqdm.tqdm(desc="Applying source fixes", total=total) as progress:
+            while pending := self.journal.edits_with_status(EditJournal.PENDING, self.batch_size):
+                for post_id, replacements in pending:
+                    self.apply_edit(post_id, replacements)
+                    progress.update(1)
+        print(f"Edit journal status: {self.journal.count_by_status()}")
+        print(self.api.latency_report())
+
+
+if __name__ == "__main__":
+    config_path = "./config.json"
+    with open(config_path, "r") as conf_file:
+        config = json.load(conf_file)
+    path = fetch_db_dump_path()
+    api = E621API(
+        "e621_source_cleanup/1.0.0 (by dr-spangle on e621)",
+        "dr-spangle",
+        config["e621_api_key"],
+        limiter=RateLimiter(rate=config.get("e621_rate_limit", 1), capacity=config.get("e621_rate_burst", 1)),
+    )
+    edit_journal = EditJournal(f"{path}.edit_journal.sqlite")
+    edit_journal.add_edits(load_fixes(f"{path}.results.json"))
+    applier = FixApplier(api, edit_journal)
+    applier.apply_all()
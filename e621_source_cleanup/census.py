@@ -0,0 +1,179 @@
+import argparse
+import csv
+import dataclasses
+import json
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Any
+
+import tqdm
+
+from e621_source_cleanup.checks.base import SourceURL, BaseCheck
+from e621_source_cleanup.dump import split_sources, iter_rows, map_shards, parse_shard, shard_ranges
+from e621_source_cleanup.main import setup_max_int, fetch_db_dump_path, all_checks, dump_output_path
+
+NO_DOMAIN = "(no domain)"
+OTHER_DOMAINS = "(other)"
+
+
+def protocol_kind(protocol: Optional[str]) -> str:
+    if protocol is None:
+        return "none"
+    if protocol in ["http", "https"]:
+        return protocol
+    return "broken"
+
+
+@dataclasses.dataclass
+class DomainStats:
+    sources: int = 0
+    protocols: Counter = dataclasses.field(default_factory=Counter)
+    checks: Counter = dataclasses.field(default_factory=Counter)
+
+    def merge(self, other: "DomainStats") -> None:
+        self.sources += other.sources
+        self.protocols.update(other.protocols)
+        self.checks.update(other.checks)
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "sources": self.sources,
+            "protocols": dict(self.protocols),
+            "checks": dict(self.checks),
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "DomainStats":
+        return cls(data["sources"], Counter(data["protocols"]), Counter(data["checks"]))
+
+
+class DomainCensus:
+    """
+    Per-domain source statistics. To keep memory bounded, once there are twice max_domains domains, the least common
+    are folded into a single "(other)" entry, so counts for rare domains are approximate.
+    """
+
+    def __init__(self, max_domains: int = 10_000) -> None:
+        self.max_domains = max_domains
+        self.domains: Dict[str, DomainStats] = {}
+        self.post_count = 0
+
+    def _stats(self, domain: str) -> DomainStats:
+        if domain not in self.domains:
+            self.domains[domain] = DomainStats()
+        return self.domains[domain]
+
+    def add_post(self, source_list: List[str], post_id: str, checks: List[BaseCheck]) -> None:
+        self.post_count += 1
+        source_domains = {}
+        for source in source_list:
+            source_url = SourceURL.decompose_source(source)
+            domain = source_url.domain_normalised or NO_DOMAIN
+            source_domains[source] = domain
+            stats = self._stats(domain)
+            stats.sources += 1
+            stats.protocols[protocol_kind(source_url.protocol)] += 1
+        for check in checks:
+            for match in check.matches(source_list, post_id) or []:
+                domain = source_domains.get(match.source, NO_DOMAIN)
+                self._stats(domain).checks[check.name] += 1
+        if len(self.domains) > 2 * self.max_domains:
+            self.prune()
+
+    def prune(self) -> None:
+        by_size = sorted(self.domains.items(), key=lambda item: item[1].sources, reverse=True)
+        self.domains = dict(by_size[:self.max_domains])
+        for domain, stats in by_size[self.max_domains:]:
+            if domain != OTHER_DOMAINS:
+                self._stats(OTHER_DOMAINS).merge(stats)
+
+    def merge(self, other: "DomainCensus") -> None:
+        self.post_count += other.post_count
+        for domain, stats in other.domains.items():
+            self._stats(domain).merge(stats)
+        if len(self.domains) > 2 * self.max_domains:
+            self.prune()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "max_domains": self.max_domains,
+            "post_count": self.post_count,
+            "domains": {domain: stats.to_json() for domain, stats in self.domains.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "DomainCensus":
+        census = cls(data["max_domains"])
+        census.post_count = data["post_count"]
+        census.domains = {domain: DomainStats.from_json(stats) for domain, stats in data["domains"].items()}
+        return census
+
+    def write_table(self, output_path: str) -> None:
+        with open(output_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["domain", "sources", "http", "https", "none", "broken", "flagged_by_check"])
+            for domain, stats in sorted(self.domains.items(), key=lambda item: item[1].sources, reverse=True):
+                check_shares = "; ".join(
+                    f"{check_name}: {count / stats.sources * 100:.2f}%"
+                    for check_name, count in stats.checks.most_common()
+                )
+                writer.writerow([
+                    domain,
+                    stats.sources,
+                    stats.protocols["http"],
+                    stats.protocols["https"],
+                    stats.protocols["none"],
+                    stats.protocols["broken"],
+                    check_shares,
+                ])
+
+    def print_summary(self, count: int = 30) -> None:
+        print(f"Census of {self.post_count} posts, over {len(self.domains)} domains")
+        for domain, stats in sorted(self.domains.items(), key=lambda item: item[1].sources, reverse=True)[:count]:
+            flagged = sum(stats.checks.values())
+            print(
+                f"- {domain}: {stats.sources} sources. "
+                f"Protocols: {', '.join(f'{kind}: {n}' for kind, n in stats.protocols.most_common())}. "
+                f"Flagged: {flagged}"
+            )
+
+
+def census_shard(csv_path: str, start: int, end: int, max_domains: int) -> DomainCensus:
+    setup_max_int()
+    checks = all_checks()
+    census = DomainCensus(max_domains)
+    for row in tqdm.tqdm(iter_rows(csv_path, start, end), desc=f"Census of shard from byte {start}"):
+        source_list = split_sources(row[4])
+        if source_list:
+            census.add_post(source_list, row[0], checks)
+    return census
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gather per-domain statistics on sources across the posts dump")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of shards to process in parallel")
+    parser.add_argument("--max-domains", type=int, default=10_000, help="Number of domains to keep exact counts for")
+    parser.add_argument("--shard", help="Only take a census of shard i/n of the dump, and write a partial result")
+    parser.add_argument("--merge", nargs="+", help="Merge partial census results and write the table")
+    args = parser.parse_args()
+    setup_max_int()
+    path = fetch_db_dump_path()
+    if args.shard:
+        shard_index, shard_count = parse_shard(args.shard)
+        shard_start, shard_end = shard_ranges(path, shard_count)[shard_index]
+        result = census_shard(path, shard_start, shard_end, args.max_domains)
+        with open(dump_output_path(path, f"census.shard-{shard_index}-of-{shard_count}.json"), "w") as partial_file:
+            json.dump(result.to_json(), partial_file)
+    else:
+        if args.merge:
+            partials = []
+            for partial_path in args.merge:
+                with open(partial_path, "r") as partial_file:
+                    partials.append(DomainCensus.from_json(json.load(partial_file)))
+        else:
+            partials = map_shards(census_shard, path, args.processes, args.max_domains)
+        result = DomainCensus(args.max_domains)
+        for partial in partials:
+            result.merge(partial)
+        result.print_summary()
+        result.write_table(dump_output_path(path, "census.csv"))
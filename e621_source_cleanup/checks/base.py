@@ -1,7 +1,12 @@
 import dataclasses
 from abc import ABC, abstractmethod
+from collections import Counter
 from typing import List, Optional, Dict, Any
 
+TRACKING_PARAMS = {"fbclid", "gclid", "igshid", "ref_src", "ref_url", "si"}
+TRACKING_PARAM_PREFIXES = ("utm_",)
+QUERYLESS_DOMAINS = {"twitter.com", "mobile.twitter.com", "x.com"}
+
 
 @dataclasses.dataclass
 class SourceURL:
@@ -18,6 +23,35 @@ class SourceURL:
             return self.domain[4:]
         return self.domain
 
+    @property
+    def domain_normalised(self) -> Optional[str]:
+        if not self.domain:
+            return None
+        domain = self.domain.lower()
+        if domain.startswith("www."):
+            return domain[4:]
+        return domain
+
+    @property
+    def normalised(self) -> Optional[str]:
+        """
+        Protocol-independent form of the URL, for spotting when two sources point at the same page
+        """
+        domain = self.domain_normalised
+        if domain is None:
+            return None
+        path, _, _ = self.path.partition("#")
+        path, _, query = path.partition("?")
+        if query and domain not in QUERYLESS_DOMAINS:
+            params = [
+                param for param in query.split("&")
+                if param and param.split("=", 1)[0].lower() not in TRACKING_PARAMS
+                and not param.lower().startswith(TRACKING_PARAM_PREFIXES)
+            ]
+            if params:
+                path += "?" + "&".join(params)
+        return f"{domain}/{path.rstrip('/')}"
+
     @classmethod
     def decompose_source(cls, source_link: str) -> Optional["SourceURL"]:
         raw = source_link
@@ -71,6 +105,16 @@ class BaseCheck(ABC):
     def report(self) -> Optional[str]:
         return None
 
+    def report_state(self) -> Dict[str, Dict[str, int]]:
+        """
+        The counters behind this check's report, so that reports from separate scans can be merged
+        """
+        return {key: dict(value) for key, value in vars(self).items() if isinstance(value, Counter)}
+
+    def merge_report_state(self, state: Dict[str, Dict[str, int]]) -> None:
+        for key, counts in state.items():
+            getattr(self, key).update(counts)
+
 
 class StringCheck(BaseCheck):
 
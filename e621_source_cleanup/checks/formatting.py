@@ -29,12 +29,12 @@ class SpacesInURL(URLCheck):
 class TitlecaseDomain(URLCheck):
 
     def __init__(self):
-        self.domains = []
+        self.domains = Counter()
 
     def matches_url(self, source_url: SourceURL, post_id: str) -> Optional[SourceMatch]:
         if source_url.domain in [source_url.domain.title(), source_url.domain.capitalize()] and source_url.domain != source_url.domain.lower():
             fix_url = f"{source_url.protocol}://{source_url.domain.lower()}/{source_url.path}"
-            self.domains.append(source_url.domain)
+            self.domains[source_url.domain] += 1
             return SourceMatch(
                 post_id,
                 source_url.raw,
@@ -45,5 +45,4 @@ class TitlecaseDomain(URLCheck):
         return None
 
     def report(self) -> Optional[str]:
-        domain_counter = Counter(self.domains)
-        return "Titlecase domain counter: " + ", ".join(f"{domain}: {count}" for domain, count in domain_counter.most_common())
+        return "Titlecase domain counter: " + ", ".join(f"{domain}: {count}" for domain, count in self.domains.most_common())
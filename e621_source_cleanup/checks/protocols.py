@@ -12,7 +12,7 @@ class MissingProtocol(URLCheck):
             "twitter.com": "https://",
             "patreon.com": "https://",
         }
-        self.report_domains = []
+        self.report_domains = Counter()
 
     def protocol_for_domain(self, domain: str) -> Optional[str]:
         if domain.endswith(".tumblr.com"):
@@ -32,7 +32,7 @@ class MissingProtocol(URLCheck):
             if fix_protocol:
                 fix_url = fix_protocol + source_url.raw
             else:
-                self.report_domains.append(source_url.domain_clean)
+                self.report_domains[source_url.domain_clean] += 1
             return SourceMatch(
                 post_id,
                 source_url.raw,
@@ -43,8 +43,9 @@ class MissingProtocol(URLCheck):
         return None
 
     def report(self) -> Optional[str]:
-        counter = Counter(self.report_domains)
-        return "Domains without protocols seen: " + ", ".join(f"{domain}: {n}" for domain, n in counter.most_common())
+        return "Domains without protocols seen: " + ", ".join(
+            f"{domain}: {n}" for domain, n in self.report_domains.most_common()
+        )
 
 
 class BrokenProtocols(URLCheck):
@@ -96,7 +97,7 @@ class UnknownProtocol(URLCheck):
             "Insta:https": "https",
             "https:https": "https",
         }
-        self.report_protocols = []
+        self.report_protocols = Counter()
 
     def matches_url(self, source_url: SourceURL, post_id: str) -> Optional[SourceMatch]:
         if not source_url.protocol:
@@ -106,7 +107,7 @@ class UnknownProtocol(URLCheck):
             if source_url.protocol in self.fixes:
                 fix_url = self.fixes[source_url.protocol] + f"://{source_url.domain}/{source_url.path}"
             else:
-                self.report_protocols.append(source_url.protocol)
+                self.report_protocols[source_url.protocol] += 1
             return SourceMatch(
                 post_id,
                 source_url.raw,
@@ -117,8 +118,9 @@ class UnknownProtocol(URLCheck):
         return None
 
     def report(self) -> Optional[str]:
-        counter = Counter(self.report_protocols)
-        return "Unknown protocols: " + ", ".join(f"{domain}: {count}" for domain, count in counter.most_common())
+        return "Unknown protocols: " + ", ".join(
+            f"{domain}: {count}" for domain, count in self.report_protocols.most_common()
+        )
 
 
 class InsecureProtocol(URLCheck):
@@ -136,7 +138,7 @@ class InsecureProtocol(URLCheck):
             "rule34.paheal.net",
             "i.imgur.com"
         }
-        self.report_domains = []
+        self.report_domains = Counter()
 
     def is_secure_domain(self, domain: str) -> bool:
         if domain in self.secure_domains:
@@ -161,7 +163,7 @@ class InsecureProtocol(URLCheck):
                 self,
                 "Using http protocol in source URL when domain supports https"
             )
-        self.report_domains.append(source_url.domain_clean)
+        self.report_domains[source_url.domain_clean] += 1
         return SourceMatch(
             post_id,
             source_url.raw,
@@ -171,5 +173,6 @@ class InsecureProtocol(URLCheck):
         )
 
     def report(self) -> Optional[str]:
-        counter = Counter(self.report_domains)
-        return "Other domains seen: " + ", ".join(f"{domain}: {count}" for domain, count in counter.most_common())
+        return "Other domains seen: " + ", ".join(
+            f"{domain}: {count}" for domain, count in self.report_domains.most_common()
+        )
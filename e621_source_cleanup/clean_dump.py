@@ -0,0 +1,78 @@
+import argparse
+import csv
+import os
+import shutil
+from typing import List, Tuple
+
+import tqdm
+
+from e621_source_cleanup.checks.base import BaseCheck
+from e621_source_cleanup.dump import split_sources, iter_rows, map_shards, read_header
+from e621_source_cleanup.main import setup_max_int, fetch_db_dump_path, all_checks, dump_output_path
+
+DIFF_HEADER = ["id", "source", "fixed_source"]
+
+
+def fix_source_list(source_list: List[str], post_id: str, checks: List[BaseCheck], max_passes: int = 3) -> List[str]:
+    # Fixes can uncover further fixable issues (e.g. a missing protocol on a tracking link), so repeat a few times
+    for _ in range(max_passes):
+        replacements = {}
+        for check in checks:
+            for match in check.matches(source_list, post_id) or []:
+                if match.replacement and match.source not in replacements:
+                    replacements[match.source] = match.replacement
+        if not replacements:
+            break
+        source_list = list(dict.fromkeys(replacements.get(source, source) for source in source_list))
+    return source_list
+
+
+def clean_shard(csv_path: str, start: int, end: int, output_path: str, diff_only: bool) -> Tuple[str, int, int]:
+    setup_max_int()
+    checks = all_checks()
+    part_path = f"{output_path}.part{start}"
+    row_count = 0
+    changed_count = 0
+    with open(part_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        for row in tqdm.tqdm(iter_rows(csv_path, start, end), desc=f"Cleaning shard from byte {start}"):
+            row_count += 1
+            post_id = row[0]
+            source_list = split_sources(row[4])
+            fixed_sources = fix_source_list(source_list, post_id, checks)
+            if fixed_sources != source_list:
+                changed_count += 1
+                if diff_only:
+                    writer.writerow([post_id, row[4], "\n".join(fixed_sources)])
+                    continue
+                row[4] = "\n".join(fixed_sources)
+            if not diff_only:
+                writer.writerow(row)
+    return part_path, row_count, changed_count
+
+
+def clean_dump(csv_path: str, output_path: str, diff_only: bool = False, processes: int = 1) -> None:
+    results = map_shards(clean_shard, csv_path, processes, output_path, diff_only)
+    with open(output_path, "w", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerow(DIFF_HEADER if diff_only else read_header(csv_path))
+    # Shard outputs are appended in shard order, so rows stay in the same order as the dump
+    with open(output_path, "ab") as f_out:
+        for part_path, _, _ in results:
+            with open(part_path, "rb") as f_in:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(part_path)
+    total_rows = sum(row_count for _, row_count, _ in results)
+    total_changed = sum(changed_count for _, _, changed_count in results)
+    print(f"Cleaned {total_rows} posts, {total_changed} had their sources changed. Written to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a copy of the posts dump with auto-fixable sources fixed")
+    parser.add_argument("--diff", action="store_true", help="Only write the rows which were changed")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of shards to process in parallel")
+    parser.add_argument("--output", help="Output CSV path")
+    args = parser.parse_args()
+    setup_max_int()
+    path = fetch_db_dump_path()
+    out_path = args.output or dump_output_path(path, "fixes.csv" if args.diff else "cleaned.csv")
+    clean_dump(path, out_path, args.diff, args.processes)
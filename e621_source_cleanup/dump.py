@@ -0,0 +1,115 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+from typing import List, Tuple, Iterator, Optional, Callable, Any
+
+
+def split_sources(sources: str) -> List[str]:
+    if not sources.strip():
+        return []
+    return [s.strip() for s in sources.strip().split("\n")]
+
+
+def read_header(csv_path: str) -> List[str]:
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        return next(csv.reader(f))
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parses a shard specifier like "2/8" into a zero-based shard index and shard count
+    """
+    index, count = shard.split("/", 1)
+    shard_index, shard_count = int(index), int(count)
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index must be between 0 and {shard_count - 1}, not {shard_index}")
+    return shard_index, shard_count
+
+
+def shard_ranges(csv_path: str, shard_count: int) -> List[Tuple[int, int]]:
+    """
+    Splits the dump into byte ranges of roughly equal size, each starting at the start of a row.
+    Fields can contain quoted newlines, so row boundaries are found by tracking quote parity from the start of the file.
+    """
+    cache_file = f"{csv_path}.shards.{shard_count}"
+    try:
+        with open(cache_file, "r") as f:
+            return [tuple(shard_range) for shard_range in json.load(f)]
+    except FileNotFoundError:
+        pass
+    file_size = os.path.getsize(csv_path)
+    boundaries = []
+    with open(csv_path, "rb") as f:
+        data_start = len(f.readline())
+        targets = [data_start + (file_size - data_start) * n // shard_count for n in range(1, shard_count)]
+        position = data_start
+        in_quotes = False
+        for line in f:
+            if len(boundaries) >= len(targets):
+                break
+            position += len(line)
+            if line.count(b"\"") % 2:
+                in_quotes = not in_quotes
+            while not in_quotes and len(boundaries) < len(targets) and position >= targets[len(boundaries)]:
+                boundaries.append(position)
+    while len(boundaries) < len(targets):
+        boundaries.append(file_size)
+    ranges = list(zip([data_start] + boundaries, boundaries + [file_size]))
+    with open(cache_file, "w") as f:
+        json.dump(ranges, f)
+    return ranges
+
+
+class _RangeReader(io.RawIOBase):
+
+    def __init__(self, raw_file: io.FileIO, end: int) -> None:
+        super().__init__()
+        self.raw_file = raw_file
+        self.end = end
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:
+        remaining = self.end - self.raw_file.tell()
+        if remaining <= 0:
+            return 0
+        data = self.raw_file.read(min(len(buffer), remaining))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        self.raw_file.close()
+        super().close()
+
+
+def iter_rows(csv_path: str, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[List[str]]:
+    """
+    Yields the rows of the dump between two row-aligned byte offsets, or the whole dump after the header by default
+    """
+    raw_file = open(csv_path, "rb", buffering=0)
+    if start is None:
+        start = len(raw_file.readline())
+    if end is None:
+        end = os.path.getsize(csv_path)
+    raw_file.seek(start)
+    reader = io.BufferedReader(_RangeReader(raw_file, end))
+    with io.TextIOWrapper(reader, encoding="utf-8", newline="") as f:
+        yield from csv.reader(f)
+
+
+def iter_shard_rows(csv_path: str, shard_index: int, shard_count: int) -> Iterator[List[str]]:
+    start, end = shard_ranges(csv_path, shard_count)[shard_index]
+    return iter_rows(csv_path, start, end)
+
+
+def map_shards(func: Callable[..., Any], csv_path: str, processes: int, *args: Any) -> List[Any]:
+    """
+    Calls func(csv_path, start, end, *args) for each shard of the dump, across a pool of processes.
+    Results are returned in shard order.
+    """
+    ranges = shard_ranges(csv_path, processes)
+    with multiprocessing.Pool(processes) as pool:
+        return pool.starmap(func, [(csv_path, start, end, *args) for start, end in ranges])
@@ -0,0 +1,85 @@
+import argparse
+import csv
+import functools
+import glob
+import multiprocessing
+import os
+import tempfile
+import zlib
+from typing import List, Dict, Tuple
+
+import tqdm
+
+from e621_source_cleanup.checks.base import SourceURL
+from e621_source_cleanup.dump import split_sources, iter_rows, map_shards
+from e621_source_cleanup.main import setup_max_int, fetch_db_dump_path, dump_output_path
+
+
+def partition_shard(csv_path: str, start: int, end: int, work_dir: str, partition_count: int) -> int:
+    """
+    Writes (normalised source, post id) pairs from one shard of the dump into partition files, by hash of the source,
+    so that each partition can be grouped separately in bounded memory.
+    """
+    setup_max_int()
+    partition_files = [
+        open(os.path.join(work_dir, f"shard{start}-part{partition}.csv"), "w", encoding="utf-8", newline="")
+        for partition in range(partition_count)
+    ]
+    writers = [csv.writer(f) for f in partition_files]
+    pair_count = 0
+    try:
+        for row in tqdm.tqdm(iter_rows(csv_path, start, end), desc=f"Partitioning shard from byte {start}"):
+            post_id = row[0]
+            for source in split_sources(row[4]):
+                normalised = SourceURL.decompose_source(source).normalised
+                if normalised is None:
+                    continue
+                partition = zlib.crc32(normalised.encode()) % partition_count
+                writers[partition].writerow([normalised, post_id])
+                pair_count += 1
+    finally:
+        for f in partition_files:
+            f.close()
+    return pair_count
+
+
+def group_partition(work_dir: str, partition: int) -> List[Tuple[str, List[str]]]:
+    post_ids_by_source: Dict[str, Dict[str, None]] = {}
+    for partition_path in glob.glob(os.path.join(work_dir, f"shard*-part{partition}.csv")):
+        with open(partition_path, "r", encoding="utf-8", newline="") as f:
+            for source, post_id in csv.reader(f):
+                post_ids_by_source.setdefault(source, {})[post_id] = None
+        os.remove(partition_path)
+    return sorted(
+        (source, list(post_ids)) for source, post_ids in post_ids_by_source.items() if len(post_ids) > 1
+    )
+
+
+def find_duplicate_sources(csv_path: str, output_path: str, processes: int = 1, partition_count: int = 256) -> None:
+    work_dir_parent = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=work_dir_parent) as work_dir:
+        pair_counts = map_shards(partition_shard, csv_path, processes, work_dir, partition_count)
+        print(f"Partitioned {sum(pair_counts)} sources into {partition_count} partitions")
+        group_count = 0
+        with open(output_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["source", "post_count", "post_ids"])
+            with multiprocessing.Pool(processes) as pool:
+                partition_groups = pool.imap(functools.partial(group_partition, work_dir), range(partition_count))
+                for groups in partition_groups:
+                    for source, post_ids in groups:
+                        writer.writerow([source, len(post_ids), " ".join(post_ids)])
+                        group_count += 1
+    print(f"Found {group_count} sources shared by more than one post. Written to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find posts sharing the same normalised source URL")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Number of shards to process in parallel")
+    parser.add_argument("--partitions", type=int, default=256, help="Number of hash partitions to group sources in")
+    parser.add_argument("--output", help="Output CSV path")
+    args = parser.parse_args()
+    setup_max_int()
+    path = fetch_db_dump_path()
+    output_path = args.output or dump_output_path(path, "duplicate_sources.csv")
+    find_duplicate_sources(path, output_path, args.processes, args.partitions)
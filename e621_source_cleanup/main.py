@@ -1,3 +1,4 @@
+import argparse
 import csv
 import glob
 import gzip
@@ -7,7 +8,7 @@ import re
 import shutil
 import sys
 from collections import Counter
-from typing import List, Dict, Tuple, Set
+from typing import List, Dict, Tuple, Set, Optional, Any
 
 import requests
 import tqdm
@@ -22,8 +23,12 @@ from e621_source_cleanup.checks.misuse import CommaCheck, TagsCheck, TextCheck,
 from e621_source_cleanup.checks.protocols import MissingProtocol, BrokenProtocols, UnknownProtocol, InsecureProtocol
 from e621_source_cleanup.checks.twitter import TwitFixCheck, TwitterTracking, MobileLink, OldDirectURL, \
     MalformedDirectLinks
+from e621_source_cleanup.dump import split_sources, iter_shard_rows, parse_shard
 
 DB_DUMP_DIR = "db_export"
+# Files derived from the dump go in their own directory, so they are never mistaken for the dump itself
+DUMP_OUTPUT_DIR = f"{DB_DUMP_DIR}/output"
+DUMP_FILE_REGEX = re.compile(r"posts-\d{4}-\d{2}-\d{2}\.csv")
 
 
 def setup_max_int() -> None:
@@ -52,6 +57,19 @@ def csv_line_count(csv_path: str) -> int:
     return line_count
 
 
+def check_sources(post_id: str, source_list: List[str], checks: List[BaseCheck]) -> List[SourceMatch]:
+    all_matches = []
+    for check in checks:
+        try:
+            matches = check.matches(source_list, post_id)
+        except Exception as e:
+            print(f"CHECK FAILURE. {check.name} failed to check {post_id}")
+            raise e
+        if matches:
+            all_matches.extend(matches)
+    return all_matches
+
+
 def scan_csv(csv_path: str, checks: List[BaseCheck]) -> Dict[str, List[SourceMatch]]:
     total_lines = csv_line_count(csv_path)
     match_dict = {}
@@ -60,27 +78,109 @@ def scan_csv(csv_path: str, checks: List[BaseCheck]) -> Dict[str, List[SourceMat
         next(reader, None)
         for row in tqdm.tqdm(reader, desc="Checking sources", total=total_lines):
             post_id = row[0]
-            sources = row[4]
-            if not sources.strip():
+            source_list = split_sources(row[4])
+            if not source_list:
                 continue
-            source_list = [s.strip() for s in sources.strip().split("\n")]
-            all_matches = []
-            for check in checks:
-                try:
-                    matches = check.matches(source_list, post_id)
-                except Exception as e:
-                    print(f"CHECK FAILURE. {check.name} failed to check {post_id}")
-                    raise e
-                if matches:
-                    all_matches.extend(matches)
+            all_matches = check_sources(post_id, source_list, checks)
             if all_matches:
                 match_dict[post_id] = all_matches
                 # print(f"Found {len(all_matches)} source match: {all_matches}")
     return match_dict
 
 
-def generate_report(csv_path: str, checks: List[BaseCheck], match_dict: Dict[str, List[SourceMatch]]) -> None:
-    total_lines = csv_line_count(csv_path)
+def scan_shard(
+        csv_path: str,
+        checks: List[BaseCheck],
+        shard_index: int,
+        shard_count: int
+) -> Tuple[Dict[str, List[SourceMatch]], int]:
+    post_count = 0
+    match_dict = {}
+    rows = iter_shard_rows(csv_path, shard_index, shard_count)
+    for row in tqdm.tqdm(rows, desc=f"Checking sources in shard {shard_index}/{shard_count}"):
+        post_count += 1
+        post_id = row[0]
+        source_list = split_sources(row[4])
+        if not source_list:
+            continue
+        all_matches = check_sources(post_id, source_list, checks)
+        if all_matches:
+            match_dict[post_id] = all_matches
+    return match_dict, post_count
+
+
+def partial_results_path(csv_path: str, shard_index: int, shard_count: int) -> str:
+    return f"{csv_path}.results.shard-{shard_index}-of-{shard_count}.json"
+
+
+def save_partial_results(
+        csv_path: str,
+        checks: List[BaseCheck],
+        shard_index: int,
+        shard_count: int,
+        match_dict: Dict[str, List[SourceMatch]],
+        post_count: int
+) -> None:
+    json_data = {
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "post_count": post_count,
+        "check_reports": {chk.name: chk.report_state() for chk in checks},
+        "results": {
+            post_id: [match.to_json() for match in matches]
+            for post_id, matches in match_dict.items()
+        },
+    }
+    with open(partial_results_path(csv_path, shard_index, shard_count), "w") as f:
+        json.dump(json_data, f)
+
+
+def merge_partial_results(
+        partial_paths: List[str],
+        checks: List[BaseCheck]
+) -> Tuple[Dict[str, List[SourceMatch]], int]:
+    checks_by_class = {(chk.__class__.__module__, chk.__class__.__name__): chk for chk in checks}
+    checks_by_name = {chk.name: chk for chk in checks}
+    match_dict = {}
+    post_count = 0
+    seen_shards = set()
+    for partial_path in partial_paths:
+        with open(partial_path, "r") as f:
+            partial: Dict[str, Any] = json.load(f)
+        shard = (partial["shard_index"], partial["shard_count"])
+        if shard in seen_shards:
+            raise ValueError(f"Shard {shard[0]}/{shard[1]} was given more than once")
+        seen_shards.add(shard)
+        post_count += partial["post_count"]
+        for check_name, report_state in partial["check_reports"].items():
+            checks_by_name[check_name].merge_report_state(report_state)
+        for post_id, matches in partial["results"].items():
+            match_dict[post_id] = [
+                SourceMatch(
+                    match["post_id"],
+                    match["source"],
+                    match["replacement"],
+                    checks_by_class[(match["check_module"], match["check_class"])],
+                    match["reason"],
+                )
+                for match in matches
+            ]
+    shard_counts = {shard_count for _, shard_count in seen_shards}
+    if len(shard_counts) == 1:
+        missing = set(range(shard_counts.pop())) - {shard_index for shard_index, _ in seen_shards}
+        if missing:
+            print(f"WARNING: Partial results are missing shards: {sorted(missing)}")
+    return match_dict, post_count
+
+
+def generate_report(
+        csv_path: str,
+        checks: List[BaseCheck],
+        match_dict: Dict[str, List[SourceMatch]],
+        total_lines: Optional[int] = None
+) -> None:
+    if total_lines is None:
+        total_lines = csv_line_count(csv_path)
     print(f"There are {total_lines} posts in the dataset")
     print(f"{len(match_dict)} posts have sources matching at least one check")
     # Build by_check dict
@@ -135,9 +235,17 @@ def generate_report(csv_path: str, checks: List[BaseCheck], match_dict: Dict[str
         json.dump(json_data, f, indent=2)
 
 
+def dump_output_path(dump_path: str, suffix: str) -> str:
+    os.makedirs(DUMP_OUTPUT_DIR, exist_ok=True)
+    return f"{DUMP_OUTPUT_DIR}/{os.path.basename(dump_path)}.{suffix}"
+
+
 def fetch_db_dump_path() -> str:
     os.makedirs(DB_DUMP_DIR, exist_ok=True)
-    files = glob.glob(f"{DB_DUMP_DIR}/*.csv")
+    files = [
+        file_path for file_path in glob.glob(f"{DB_DUMP_DIR}/*.csv")
+        if DUMP_FILE_REGEX.fullmatch(os.path.basename(file_path))
+    ]
     if files:
         return sorted(files)[-1]
     dump_listing = requests.get("https://e621.net/db_export/").content.decode("utf-8")
@@ -158,10 +266,8 @@ def fetch_db_dump_path() -> str:
     return f"{DB_DUMP_DIR}/{last_dump_csv}"
 
 
-if __name__ == "__main__":
-    setup_max_int()
-    path = fetch_db_dump_path()
-    checkers = [
+def all_checks() -> List[BaseCheck]:
+    return [
         TwitFixCheck(),
         TwitterTracking(),
         MobileLink(),
@@ -190,5 +296,26 @@ if __name__ == "__main__":
         TitlecaseDomain(),
         OldFormatUserPage(),
     ]
-    match_result = scan_csv(path, checkers)
-    generate_report(path, checkers, match_result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan the e621 posts dump for source issues")
+    parser.add_argument("--shard", help="Only scan shard i/n of the dump, and write a partial results file")
+    parser.add_argument("--merge", nargs="+", help="Merge partial results files and generate the report")
+    args = parser.parse_args()
+    setup_max_int()
+    checkers = all_checks()
+    if args.merge:
+        # Partial results files are named after their dump, so merging does not need the dump itself
+        path = args.merge[0].rsplit(".results.shard-", 1)[0]
+        match_result, posts_scanned = merge_partial_results(args.merge, checkers)
+        generate_report(path, checkers, match_result, posts_scanned)
+    elif args.shard:
+        path = fetch_db_dump_path()
+        index, count = parse_shard(args.shard)
+        match_result, posts_scanned = scan_shard(path, checkers, index, count)
+        save_partial_results(path, checkers, index, count, match_result, posts_scanned)
+    else:
+        path = fetch_db_dump_path()
+        match_result = scan_csv(path, checkers)
+        generate_report(path, checkers, match_result)
@@ -0,0 +1,68 @@
+from typing import Dict, List, Optional
+
+from e621_source_cleanup.apply_fixes import EditJournal, FixApplier
+
+
+class FakeAPI:
+
+    def __init__(self, sources: Dict[str, List[str]]) -> None:
+        self.sources = sources
+        self.get_post_error: Optional[str] = None
+        self.patched: List[str] = []
+
+    def get_post(self, post_id: str) -> Dict:
+        if self.get_post_error is not None:
+            raise Exception(self.get_post_error)
+        return {"post": {"sources": self.sources[str(post_id)]}}
+
+    def replace_sources(self, post_id: str, replacements: Dict[str, str]) -> Dict:
+        self.patched.append(str(post_id))
+        post_sources = self.sources[str(post_id)]
+        self.sources[str(post_id)] = [replacements.get(source, source) for source in post_sources]
+        return {}
+
+    def latency_report(self) -> str:
+        return ""
+
+
+def journal_status(journal: EditJournal, post_id: str) -> str:
+    return journal.conn.execute("SELECT status FROM edits WHERE post_id = ?", (post_id,)).fetchone()[0]
+
+
+def crashed_journal(tmp_path) -> EditJournal:
+    journal = EditJournal(str(tmp_path / "journal.sqlite"))
+    journal.add_edits([("1", {"http://a": "https://a"}), ("2", {"http://b": "https://b"})])
+    # Simulate a crash after the request for post 1 was made, but before its result was recorded
+    journal.set_status("1", EditJournal.SENDING)
+    return journal
+
+
+def test_in_doubt_edit_is_not_resent_when_it_cannot_be_checked(tmp_path):
+    journal = crashed_journal(tmp_path)
+    api = FakeAPI({"1": ["https://a"], "2": ["http://b"]})
+    api.get_post_error = "not found"
+    FixApplier(api, journal).apply_all()
+    assert api.patched == ["2"]
+    assert journal_status(journal, "1") == EditJournal.UNVERIFIED
+    # Once it can be checked, an edit which had been applied is marked done, without sending it again
+    api.get_post_error = None
+    FixApplier(api, journal).apply_all()
+    assert api.patched == ["2"]
+    assert journal_status(journal, "1") == EditJournal.DONE
+
+
+def test_in_doubt_edit_is_resent_when_check_shows_it_was_not_applied(tmp_path):
+    journal = crashed_journal(tmp_path)
+    api = FakeAPI({"1": ["http://a"], "2": ["http://b"]})
+    FixApplier(api, journal).apply_all()
+    assert sorted(api.patched) == ["1", "2"]
+    assert journal_status(journal, "1") == EditJournal.DONE
+    assert journal_status(journal, "2") == EditJournal.DONE
+
+
+def test_in_doubt_edit_already_applied_is_not_resent(tmp_path):
+    journal = crashed_journal(tmp_path)
+    api = FakeAPI({"1": ["https://a"], "2": ["http://b"]})
+    FixApplier(api, journal).apply_all()
+    assert api.patched == ["2"]
+    assert journal_status(journal, "1") == EditJournal.DONE
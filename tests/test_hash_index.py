@@ -0,0 +1,45 @@
+import random
+from typing import List
+
+from e621_gallery_finder.hash_index import MultiIndexHash, hamming_distance
+
+
+def flip_bits(hash_int: int, bits: List[int]) -> int:
+    for bit in bits:
+        hash_int ^= 1 << bit
+    return hash_int
+
+
+def test_chunk_count_matches_max_distance():
+    for bit_length in [64, 256]:
+        for max_distance in [0, 1, 8, 10, 20, 63]:
+            index = MultiIndexHash(bit_length, max_distance)
+            assert len(index.chunk_shapes) == max_distance + 1
+
+
+def test_finds_hash_at_max_distance_with_one_bit_per_chunk():
+    for max_distance in [8, 10, 20]:
+        index = MultiIndexHash(64, max_distance)
+        base = random.Random(max_distance).getrandbits(64)
+        index.add(base, 1)
+        # Flip one bit in all but one chunk, which is as spread out as a match at max_distance can be
+        query = flip_bits(base, [shift for shift, _ in index.chunk_shapes[:max_distance]])
+        assert hamming_distance(base, query) == max_distance
+        assert index.search(query) == {1: max_distance}
+
+
+def test_search_matches_brute_force():
+    rand = random.Random(0)
+    max_distance = 8
+    index = MultiIndexHash(64, max_distance)
+    hashes = [rand.getrandbits(64) for _ in range(200)]
+    for item, hash_int in enumerate(hashes):
+        index.add(hash_int, item)
+    for _ in range(200):
+        query = flip_bits(rand.choice(hashes), rand.sample(range(64), rand.randint(0, max_distance + 2)))
+        expected = {
+            item: hamming_distance(query, hash_int)
+            for item, hash_int in enumerate(hashes)
+            if hamming_distance(query, hash_int) <= max_distance
+        }
+        assert index.search(query) == expected
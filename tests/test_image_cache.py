@@ -0,0 +1,139 @@
+import http.server
+import importlib
+import json
+import os
+import threading
+from collections import Counter
+from typing import Iterator
+
+import pytest
+
+from e621_gallery_finder.image_cache import ImageCache, UnsupportedImage
+
+IMAGE_SIZE = 1000
+
+
+class ImageServer:
+    """
+    Serves fake images over HTTP on a local port, counting the requests for each path.
+    """
+
+    def __init__(self) -> None:
+        self.hits = Counter()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                server.hits[self.path] += 1
+                content_type = "video/webm" if self.path.endswith(".webm") else "image/png"
+                # Not a decodable image, so it is stored as it is, rather than as a thumbnail of unpredictable size
+                body = self.path.encode().ljust(IMAGE_SIZE, b"x")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.origin = f"http://127.0.0.1:{self.httpd.server_port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path: str) -> str:
+        return self.origin + path
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture(scope="module")
+def image_server() -> Iterator[ImageServer]:
+    server = ImageServer()
+    yield server
+    server.close()
+
+
+def test_default_origins_only_allow_image_hosts(tmp_path):
+    cache = ImageCache("test", str(tmp_path))
+    assert cache.is_allowed("https://static1.e621.net/data/ab/cd/abcd.png")
+    assert cache.is_allowed("https://pbs.twimg.com/media/abc.jpg")
+    assert not cache.is_allowed("http://static1.e621.net/data/ab/cd/abcd.png")
+    assert not cache.is_allowed("https://static1.e621.net:8443/data/ab/cd/abcd.png")
+    assert not cache.is_allowed("https://evil.example@static1.e621.net/")
+    assert not cache.is_allowed("https://127.0.0.1/")
+
+
+def test_evicts_least_recently_used(tmp_path, image_server):
+    cache = ImageCache("test", str(tmp_path), max_bytes=int(IMAGE_SIZE * 2.5))
+    cache.get(image_server.url("/a.png"))
+    cache.get(image_server.url("/b.png"))
+    cache.get(image_server.url("/a.png"))
+    cache.get(image_server.url("/c.png"))
+    assert image_server.hits["/a.png"] == 1
+    cached_keys = set(cache.images.keys())
+    assert cached_keys == {cache.cache_key(image_server.url(path)) for path in ["/a.png", "/c.png"]}
+    assert {path.stem for path in tmp_path.iterdir()} == cached_keys
+    # The evicted image is fetched again, and the cache index survives a restart
+    cache.get(image_server.url("/b.png"))
+    assert image_server.hits["/b.png"] == 2
+    reloaded = ImageCache("test", str(tmp_path), max_bytes=int(IMAGE_SIZE * 2.5))
+    assert set(reloaded.images.keys()) == set(cache.images.keys())
+
+
+def test_non_images_are_not_cached(tmp_path, image_server):
+    cache = ImageCache("test", str(tmp_path))
+    for _ in range(2):
+        with pytest.raises(UnsupportedImage):
+            cache.get(image_server.url("/clip.webm"))
+    assert image_server.hits["/clip.webm"] == 1
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.fixture(scope="module")
+def web_client(tmp_path_factory, image_server):
+    work_dir = tmp_path_factory.mktemp("web")
+    with open(work_dir / "config.json", "w") as f:
+        json.dump({
+            "e621_api_key": "test",
+            "web_auth_key": "test_auth",
+            "image_cache_dir": str(work_dir / "image_cache"),
+            "image_cache_allowed_origins": [image_server.origin],
+        }, f)
+    # The web app reads its config and database from the working directory when it is imported
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        web = importlib.import_module("e621_gallery_finder.web")
+    finally:
+        os.chdir(old_cwd)
+    client = web.app.test_client()
+    client.set_cookie("auth_key", "test_auth")
+    return client
+
+
+def test_image_endpoint_serves_from_cache(web_client, image_server):
+    url = image_server.url("/post.png")
+    for _ in range(2):
+        resp = web_client.get("/image", query_string={"url": url})
+        assert resp.status_code == 200
+        assert resp.mimetype == "image/png"
+        assert resp.data.startswith(b"/post.png")
+    assert image_server.hits["/post.png"] == 1
+    resp = web_client.get("/image", query_string={"url": url}, headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+
+def test_image_endpoint_refuses_other_hosts(web_client):
+    resp = web_client.get("/image", query_string={"url": "http://127.0.0.1:1/secret.png"})
+    assert resp.status_code == 403
+
+
+def test_image_endpoint_redirects_non_images(web_client, image_server):
+    url = image_server.url("/video.webm")
+    resp = web_client.get("/image", query_string={"url": url})
+    assert resp.status_code == 302
+    assert resp.headers["Location"] == url